@@ -0,0 +1,139 @@
+"""
+shared code of the stand-in executables.
+
+The stand-ins write outputs in the formats of the real tools, derived
+from the input sequences, so pygmes does all of its own work on them.
+Each call sleeps for PYGMES_FAKE_LATENCY seconds plus
+PYGMES_FAKE_LATENCY_PER_MB seconds per MB of input, and is logged as a
+JSON line to PYGMES_FAKE_LOG, if set.
+"""
+
+import hashlib
+import json
+import os
+import resource
+import time
+
+_bases = "TCAG"
+_aminoacids = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+_codons = {}
+for i, a in enumerate(_bases):
+    for j, b in enumerate(_bases):
+        for k, c in enumerate(_bases):
+            _codons[a + b + c] = _aminoacids[16 * i + 4 * j + k]
+_complement = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+# synthetic species the hits point to, see benchmarks/synthetic.py
+BACTERIA = [200101, 200102, 200201]
+EUKARYOTES = [400101, 400102, 400201]
+ARCHAEA = [300101]
+
+started = time.time()
+
+
+def read_fasta(path):
+    """returns a list of (name, sequence)"""
+    records = []
+    with open(path) as fin:
+        for line in fin:
+            if line.startswith(">"):
+                records.append([line[1:].split()[0], []])
+            elif len(records) > 0:
+                records[-1][1].append(line.strip())
+    return [(name, "".join(seq)) for name, seq in records]
+
+
+def translate(seq, strand="+"):
+    if strand == "-":
+        seq = seq.translate(_complement)[::-1]
+    seq = seq.upper()
+    protein = "".join([_codons.get(a + b + c, "X") for a, b, c in zip(seq[0::3], seq[1::3], seq[2::3])])
+    # stop codons inside a gene are read through, as in a real gene
+    return "M" + protein[1:].replace("*", "W")
+
+
+def genes(length, spacing, genelength, offset=0):
+    """evenly spaced genes as (start, stop, strand), 1-based and inclusive"""
+    found = []
+    for i, start in enumerate(range(1 + offset, length - genelength, spacing)):
+        found.append((start, start + genelength - 1, "+" if i % 2 == 0 else "-"))
+    return found
+
+
+def write_prodigal(genome, coords, faa):
+    """prodigal output, a gene every 1000 bp"""
+    with open(coords, "w") as co, open(faa, "w") as fout:
+        for contig, seq in read_fasta(genome):
+            co.write('DEFINITION  seqnum=1;seqlen={};seqhdr="{}"\n'.format(len(seq), contig))
+            for i, (start, stop, strand) in enumerate(genes(len(seq), 1000, 900), 1):
+                first = start - 1
+                protein = translate(seq[first:stop], strand)
+                strandcode = "1" if strand == "+" else "-1"
+                co.write("     CDS             {}..{}\n".format(start, stop))
+                fout.write(
+                    ">{}_{} # {} # {} # {} # ID=1_{};partial=00;start_type=ATG\n{}*\n".format(
+                        contig, i, start, stop, strandcode, i, protein
+                    )
+                )
+
+
+def write_gtf(genome, gtf, offset=0):
+    """GeneMark-ES gtf, genes of two exons 1050 bp apart with an intron of 150 bp"""
+    with open(gtf, "w") as fout:
+        n = 0
+        for contig, seq in read_fasta(genome):
+            for start, stop, strand in genes(len(seq), 1500, 1050, offset):
+                n += 1
+                attributes = 'gene_id "{}_g"; transcript_id "{}_t";'.format(n, n)
+                for feature, s, e in [
+                    ("CDS", start, start + 449),
+                    ("intron", start + 450, start + 599),
+                    ("CDS", start + 600, stop),
+                ]:
+                    row = [contig, "GeneMark.hmm", feature, str(s), str(e), ".", strand, "0", attributes]
+                    fout.write("\t".join(row) + "\n")
+    return n
+
+
+def kingdom(protein):
+    """
+    the bins of the generator differ in GC content, which shows in the
+    amino acids. Proteins of GC rich bins are taken as bacterial
+    """
+    rich = sum([protein.count(a) for a in "AGPR"])
+    poor = sum([protein.count(a) for a in "KNIFY"])
+    if rich > 1.5 * poor:
+        return BACTERIA
+    if poor > rich:
+        return EUKARYOTES
+    return ARCHAEA
+
+
+def pick(name, choices):
+    h = int(hashlib.md5(name.encode()).hexdigest(), 16)
+    return choices[h % len(choices)], h
+
+
+def wait(*inputs):
+    """sleep for the configured latency of a call on inputs"""
+    latency = float(os.environ.get("PYGMES_FAKE_LATENCY", "0"))
+    permb = float(os.environ.get("PYGMES_FAKE_LATENCY_PER_MB", "0"))
+    size = sum([os.path.getsize(f) for f in inputs if os.path.exists(f)])
+    latency += permb * size / 1e6
+    if latency > 0:
+        time.sleep(latency)
+
+
+def log(tool, status=0):
+    path = os.environ.get("PYGMES_FAKE_LOG")
+    if path is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    entry = {
+        "tool": tool,
+        "wall": time.time() - started,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "status": status,
+    }
+    with open(path, "a") as fout:
+        fout.write(json.dumps(entry) + "\n")
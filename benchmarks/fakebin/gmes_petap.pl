@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+stand-in for gmes_petap.pl, in self training (--ES) or prediction
+(--predict_with) mode. Self training fails on genomes with notrain in
+their name, so the pre model fallback of pygmes is used for them
+"""
+
+import os
+import sys
+import fakelib
+
+args = sys.argv
+genome = args[args.index("--sequence") + 1]
+training = "--ES" in args
+fakelib.wait(genome)
+if training and "notrain" in os.path.basename(genome):
+    print("self training failed, too few genes")
+    fakelib.log("gmes_petap.pl", 1)
+    sys.exit(1)
+
+# a different model finds the genes at slightly different places
+offset = 0
+if not training:
+    model = args[args.index("--predict_with") + 1]
+    offset = fakelib.pick(os.path.basename(model), [0, 30, 60, 90])[0]
+
+fakelib.write_gtf(genome, "genemark.gtf", offset)
+
+if training:
+    for folder in ["output", "run", "info", "data", "output/data", "output/gmhmm"]:
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join("output", "gmhmm.mod"), "w") as fout:
+        fout.write("# synthetic model trained on {}\n".format(os.path.basename(genome)))
+fakelib.log("gmes_petap.pl")
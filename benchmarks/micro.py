@@ -0,0 +1,308 @@
+"""
+micro benchmarks of the pure Python parts of pygmes that handle large inputs.
+
+Each benchmark runs on generated fixtures at several scales and reports
+its throughput. The results are compared to benchmarks/baseline.json, a
+benchmark is a regression if its throughput dropped by more than the
+threshold:
+
+    python benchmarks/micro.py                 # compare to the baseline
+    python benchmarks/micro.py --save          # store a new baseline
+    python benchmarks/micro.py clean_fasta --scales small
+
+Throughput depends on the machine, so compare against a baseline made
+on the same machine.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, os.path.join(here, "fakebin"))
+import fakelib  # noqa: E402
+import synthetic  # noqa: E402
+from pygmes.api import pygmes, single_fasta  # noqa: E402
+from pygmes.diamond import majorityvote, multidiamond  # noqa: E402
+from pygmes.exec import gmes  # noqa: E402
+from pygmes.models import modelindex  # noqa: E402
+from pygmes.prodigal import prodigal  # noqa: E402
+
+BASELINE = os.path.join(here, "baseline.json")
+# genome size in bp, number of diamond hits, lineages and models
+SCALES = {
+    "small": {"bp": 1000000, "hits": 20000, "lineages": 2000, "models": 1000},
+    "medium": {"bp": 5000000, "hits": 200000, "lineages": 20000, "models": 10000},
+    "large": {"bp": 20000000, "hits": 1000000, "lineages": 100000, "models": 50000},
+}
+LINEAGES = [
+    [1, 131567, 2, 2001, 20010, 200101],
+    [1, 131567, 2, 2001, 20010, 200102],
+    [1, 131567, 2, 2001, 20020, 200201],
+    [1, 131567, 2759, 4751, 4001, 40010, 400101],
+    [1, 131567, 2759, 4751, 4001, 40020, 400201],
+]
+TAXA = ["200101", "200102", "200201", "400101", "400201", "200101;200102"]
+
+
+class fixtures:
+    """input files of one scale, generated once and kept in folder"""
+
+    def __init__(self, folder, scale):
+        self.folder = os.path.join(folder, scale)
+        self.scale = SCALES[scale]
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def genome(self):
+        path = self.path("genome.fa")
+        if not os.path.exists(path):
+            synthetic.write_genome(path, self.scale["bp"], synthetic.GC["euk"], seed=7)
+        return path
+
+    def genome_gz(self):
+        path = self.path("genome.fa.gz")
+        if not os.path.exists(path):
+            tmp = path + ".tmp"
+            with open(self.genome(), "rb") as fin, gzip.open(tmp, "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+            os.replace(tmp, path)
+        return path
+
+    def gtf(self):
+        path = self.path("genemark.gtf")
+        if not os.path.exists(path):
+            fakelib.write_gtf(self.genome(), path)
+        return path
+
+    def genemark_proteins(self):
+        """proteins named by their gene id, as in prot_seq.faa of GeneMark-ES"""
+        path = self.path("prot_seq.faa")
+        if not os.path.exists(path):
+            rng = random.Random(7)
+            tmp = path + ".tmp"
+            with open(self.gtf()) as fin, open(tmp, "w") as fout:
+                for line in fin:
+                    if "\tintron\t" in line:
+                        gene = line.split('gene_id "')[1].split('"')[0]
+                        seq = "".join(rng.choices("ACDEFGHIKLMNPQRSTVWY", k=349))
+                        fout.write(">{}\nM{}\n".format(gene, seq))
+            os.replace(tmp, path)
+        return path
+
+    def prodigal_proteins(self):
+        path = self.path("prot.faa")
+        if not os.path.exists(path):
+            fakelib.write_prodigal(self.genome(), self.path("genecoord.bgk"), path)
+        return path
+
+    def diamond_hits(self):
+        """hits of proteins of 100 bins"""
+        path = self.path("diamond.result")
+        if not os.path.exists(path):
+            rng = random.Random(7)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as fout:
+                for i in range(self.scale["hits"]):
+                    protein = i // 3
+                    fout.write(
+                        "bin{}.fa_binseperator_ctg{}_{}\tref|{}\t{:.1f}\t{:.2e}\t{:.1f}\t{}\n".format(
+                            protein % 100,
+                            protein // 100,
+                            protein % 7,
+                            i,
+                            rng.uniform(30, 100),
+                            10 ** -rng.uniform(20, 100),
+                            rng.uniform(50, 500),
+                            rng.choice(TAXA),
+                        )
+                    )
+            os.replace(tmp, path)
+        return path
+
+
+def mb(path):
+    return os.path.getsize(path) / 1e6
+
+
+def count_records(path):
+    with open(path) as fin:
+        return sum([1 for line in fin if line.startswith(">")])
+
+
+def bench_clean_fasta(f, out):
+    genome = f.genome()
+    cleaner = pygmes.__new__(pygmes)
+    return (lambda: cleaner.clean_fasta(genome, out, reuse=False)), mb(genome), "MB"
+
+
+def bench_clean_fasta_gz(f, out):
+    genome = f.genome_gz()
+    cleaner = pygmes.__new__(pygmes)
+    # throughput of the uncompressed genome, to compare with clean_fasta
+    return (lambda: cleaner.clean_fasta(genome, out, reuse=False)), mb(f.genome()), "MB"
+
+
+def bench_parse_gtf(f, out):
+    gtf = f.gtf()
+    g = gmes(f.genome(), out, ncores=4)
+    return (lambda: g.parse_gtf(gtf)), mb(gtf), "MB"
+
+
+def bench_rename_for_CAT(f, out):
+    faa = f.genemark_proteins()
+    g = gmes(f.genome(), out, ncores=4)
+    g.gtf = f.gtf()
+
+    def run():
+        # rename_for_CAT skips the work if its outputs exist
+        for path in [os.path.join(out, "prot_final.faa"), g.bedfile_path()]:
+            if os.path.exists(path):
+                os.remove(path)
+        g.rename_for_CAT(faa)
+
+    return run, count_records(faa), "proteins"
+
+
+def bench_make_bed(f, out):
+    faa = f.prodigal_proteins()
+    p = prodigal(f.genome(), out, run=False)
+    p.faa = faa
+    return p.make_bed, count_records(faa), "proteins"
+
+
+def bench_majorityvote(f, out):
+    rng = random.Random(7)
+    # mostly one lineage, so the vote goes deep
+    lngs = [rng.choice(LINEAGES[:1] * 8 + LINEAGES) for i in range(f.scale["lineages"])]
+    return (lambda: majorityvote(lngs)), len(lngs), "lineages"
+
+
+def bench_parse_results(f, out):
+    hits = f.diamond_hits()
+    d = multidiamond.__new__(multidiamond)
+    return (lambda: d.parse_results(hits)), f.scale["hits"], "hits"
+
+
+def bench_score_models(f, out):
+    rng = random.Random(7)
+    lineages = {}
+    for i in range(f.scale["models"]):
+        lng = rng.choice(LINEAGES)
+        lineages["model{}".format(i)] = lng[:-1] + [lng[-1] * 100 + i % 50]
+    index = modelindex(lineages)
+    g = gmes(f.genome(), out, ncores=4)
+    return (lambda: g.score_models(index, LINEAGES[3])), len(lineages), "models"
+
+
+def bench_single_fasta(f, out):
+    faa = f.prodigal_proteins()
+    # the proteomes of 20 bins
+    fastas = [faa] * 20
+    names = ["bin{}".format(i) for i in range(len(fastas))]
+    output = os.path.join(out, "cat.faa")
+    return (lambda: single_fasta(fastas, names, output)), mb(faa) * len(fastas), "MB"
+
+
+BENCHMARKS = {
+    "clean_fasta": bench_clean_fasta,
+    "clean_fasta_gz": bench_clean_fasta_gz,
+    "parse_gtf": bench_parse_gtf,
+    "rename_for_CAT": bench_rename_for_CAT,
+    "make_bed": bench_make_bed,
+    "majorityvote": bench_majorityvote,
+    "parse_results": bench_parse_results,
+    "score_models": bench_score_models,
+    "single_fasta": bench_single_fasta,
+}
+
+
+def measure(name, scale, workdir, repeat, mintime):
+    f = fixtures(os.path.join(workdir, "fixtures"), scale)
+    out = os.path.join(workdir, "runs", name, scale)
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.makedirs(out)
+    func, amount, unit = BENCHMARKS[name](f, out)
+    # short benchmarks are repeated until they ran for mintime, the fastest run counts
+    times = []
+    while len(times) < repeat or sum(times) < mintime:
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {"seconds": best, "amount": amount, "unit": "{}/s".format(unit), "throughput": amount / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks of pygmes, compared to a stored baseline.")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="Any of: %s" % ", ".join(BENCHMARKS))
+    parser.add_argument("--scales", nargs="+", default=list(SCALES), choices=list(SCALES), help="Fixture sizes")
+    parser.add_argument("--workdir", "-w", type=str, default="pygmes-benchmark", help="Folder for the fixtures")
+    parser.add_argument("--repeat", type=int, default=3, help="Run each benchmark at least this often")
+    parser.add_argument(
+        "--min-time", dest="mintime", type=float, default=1, help="Repeat each benchmark for at least this many seconds"
+    )
+    parser.add_argument("--baseline", type=str, default=BASELINE, help="Baseline to compare to or to save")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25, help="Fraction of the baseline throughput that may be lost"
+    )
+    parser.add_argument("--save", action="store_true", default=False, help="Save the results as the new baseline")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    unknown = set(options.benchmarks) - set(BENCHMARKS)
+    if len(unknown) > 0:
+        parser.error("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as fin:
+            baseline = json.load(fin)["results"]
+
+    results = {}
+    regressions = []
+    print("\t".join(["benchmark", "seconds", "throughput", "unit", "baseline", "change"]))
+    for name in options.benchmarks:
+        for scale in options.scales:
+            key = "{}/{}".format(name, scale)
+            r = measure(name, scale, os.path.abspath(options.workdir), max(1, options.repeat), options.mintime)
+            results[key] = r
+            row = [key, "%.4f" % r["seconds"], "%.1f" % r["throughput"], r["unit"], "-", "-"]
+            if key in baseline:
+                ratio = r["throughput"] / baseline[key]["throughput"]
+                row[4] = "%.1f" % baseline[key]["throughput"]
+                row[5] = "%+.0f%%" % (100 * (ratio - 1))
+                if ratio < 1 - options.threshold:
+                    regressions.append(key)
+                    row[5] += " REGRESSION"
+            print("\t".join(row), flush=True)
+
+    if options.save:
+        # keep the baseline of benchmarks that were not run
+        baseline.update(results)
+        with open(options.baseline, "w") as fout:
+            json.dump(
+                {"machine": platform.platform(), "python": platform.python_version(), "results": baseline},
+                fout,
+                indent=1,
+                sort_keys=True,
+            )
+            fout.write("\n")
+        print("Saved the baseline to %s" % options.baseline)
+    elif len(regressions) > 0:
+        print("%d benchmarks are slower than the baseline: %s" % (len(regressions), ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+measure the time and memory pygmes itself needs, without the external tools.
+
+Each scenario runs pygmes from this source tree in a separate process,
+with stand-ins for gmes_petap.pl, prodigal and diamond (see fakebin) on
+synthetic inputs (see synthetic.py). The stand-ins log their own run
+time, so what is left is the overhead of pygmes:
+
+    python benchmarks/run.py single meta-10 --ncores 4 --json results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import synthetic  # noqa: E402
+
+SCENARIOS = ["single", "premodel", "meta-10", "meta-100", "meta-1000"]
+DEFAULT = ["single", "premodel", "meta-10", "meta-100"]
+
+
+def prepare(scenario, inputs, options):
+    """create the synthetic inputs of a scenario, returns the input path"""
+    if scenario == "single":
+        path = os.path.join(inputs, "genome_{}.fa".format(options.genome_size))
+        if not os.path.exists(path):
+            synthetic.write_genome(path, options.genome_size, synthetic.GC["euk"], seed=1)
+        return path
+    if scenario == "premodel":
+        path = os.path.join(inputs, "notrain_{}.fa".format(options.genome_size))
+        if not os.path.exists(path):
+            synthetic.write_genome(path, options.genome_size, synthetic.GC["euknotrain"], seed=2)
+        return path
+    count = int(scenario.split("-")[1])
+    folder = os.path.join(inputs, "bins_{}_{}".format(count, options.bin_size))
+    synthetic.write_bins(folder, count, options.bin_size)
+    return folder
+
+
+def child(options):
+    """run a scenario in this process and print the resources it used"""
+    import logging
+    from pygmes.api import pygmes, metapygmes
+    from pygmes.resultcache import set_resultcache
+
+    logging.basicConfig(level=logging.WARNING, filename=os.path.join(options.output, "benchmark.log"))
+    # measure the work, not the cache
+    set_resultcache(enabled=False)
+    start = time.time()
+    if options.child in ("single", "premodel"):
+        pygmes(options.input, options.output, options.db, ncores=options.ncores)
+    else:
+        metapygmes(options.input, options.output, options.db, ncores=options.ncores)
+    wall = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print(json.dumps({"wall": wall, "cpu": usage.ru_utime + usage.ru_stime, "maxrss": usage.ru_maxrss / 1024}))
+
+
+def run(scenario, options):
+    workdir = os.path.abspath(options.workdir)
+    inputs = os.path.join(workdir, "inputs")
+    os.makedirs(inputs, exist_ok=True)
+    db = synthetic.write_database(os.path.join(inputs, "db.dmnd"))
+    taxonomy = os.path.join(inputs, "taxonomy.bin")
+    if not os.path.exists(taxonomy):
+        synthetic.write_synthetic_taxonomy(taxonomy)
+    mirror = synthetic.write_model_mirror(os.path.join(inputs, "mirror"))
+    path = prepare(scenario, inputs, options)
+
+    rundir = os.path.join(workdir, "runs", scenario)
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    output = os.path.join(rundir, "output")
+    os.makedirs(output)
+    toollog = os.path.join(rundir, "tools.jsonl")
+    env = dict(os.environ)
+    env.update(
+        {
+            "PATH": os.path.join(here, "fakebin") + os.pathsep + env.get("PATH", ""),
+            "PYGMES_CACHE": os.path.join(rundir, "cache"),
+            "PYGMES_TAXONOMY": taxonomy,
+            "PYGMES_MODELS": os.path.join(rundir, "models"),
+            "PYGMES_MODELS_URL": mirror,
+            "PYGMES_FAKE_LOG": toollog,
+            "PYGMES_FAKE_LATENCY": str(options.latency),
+        }
+    )
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", scenario, "--input", path, "--output", output]
+    cmd += ["--db", db, "--ncores", str(options.ncores)]
+    p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        print(p.stderr, file=sys.stderr)
+        raise RuntimeError("Scenario %s failed, see %s" % (scenario, os.path.join(output, "benchmark.log")))
+    result = json.loads(p.stdout.strip().split("\n")[-1])
+
+    tools = {}
+    if os.path.exists(toollog):
+        with open(toollog) as fin:
+            for line in fin:
+                entry = json.loads(line)
+                t = tools.setdefault(entry["tool"], {"calls": 0, "wall": 0.0, "cpu": 0.0})
+                t["calls"] += 1
+                t["wall"] += entry["wall"]
+                t["cpu"] += entry["cpu"]
+    result.update({"scenario": scenario, "ncores": options.ncores, "latency": options.latency, "tools": tools})
+    return result
+
+
+def report(results):
+    header = ["scenario", "wall s", "pygmes cpu s", "peak rss MB", "tool calls", "tool wall s", "tool cpu s"]
+    print("\t".join(header))
+    for r in results:
+        tools = r["tools"].values()
+        row = [
+            r["scenario"],
+            "%.2f" % r["wall"],
+            "%.2f" % r["cpu"],
+            "%.1f" % r["maxrss"],
+            str(sum([t["calls"] for t in tools])),
+            "%.2f" % sum([t["wall"] for t in tools]),
+            "%.2f" % sum([t["cpu"] for t in tools]),
+        ]
+        print("\t".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of pygmes with stand-in tools.")
+    parser.add_argument("scenarios", nargs="*", default=DEFAULT, help="Any of: %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--workdir", "-w", type=str, default="pygmes-benchmark", help="Folder for inputs and runs")
+    parser.add_argument("--ncores", "-n", type=int, default=4, help="Number of cores given to pygmes")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds each call of a stand-in tool takes")
+    parser.add_argument("--genome-size", dest="genome_size", type=int, default=2000000, help="bp of single genomes")
+    parser.add_argument("--bin-size", dest="bin_size", type=int, default=200000, help="bp of each bin")
+    parser.add_argument("--repeat", type=int, default=1, help="Run each scenario this often and keep the fastest")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this file")
+    # used to run a scenario in a separate process
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--input", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--db", type=str, default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.child is not None:
+        child(options)
+        return
+
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if len(unknown) > 0:
+        parser.error("Unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    results = []
+    for scenario in options.scenarios:
+        runs = [run(scenario, options) for i in range(max(1, options.repeat))]
+        results.append(min(runs, key=lambda r: r["wall"]))
+    report(results)
+    if options.json is not None:
+        with open(options.json, "w") as fout:
+            json.dump(results, fout, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+synthetic inputs for the benchmarks: genomes and bins, a small
+taxonomy snapshot, an empty diamond database and a model mirror.
+"""
+
+import glob
+import gzip
+import hashlib
+import os
+import sys
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from pygmes.taxonomy import write_taxonomy  # noqa: E402
+
+# GC content of the bins, the stand-in diamond infers the kingdom from it
+GC = {"bac": 0.68, "euk": 0.38, "euknotrain": 0.38}
+
+TAXONOMY = [
+    (1, 1, "no rank", "root"),
+    (131567, 1, "no rank", "cellular organisms"),
+    (2, 131567, "superkingdom", "Bacteria"),
+    (2001, 2, "phylum", "Synthetic bacteria"),
+    (20010, 2001, "genus", "Synthbac"),
+    (200101, 20010, "species", "Synthbac alpha"),
+    (200102, 20010, "species", "Synthbac beta"),
+    (20020, 2001, "genus", "Fakebac"),
+    (200201, 20020, "species", "Fakebac gamma"),
+    (2157, 131567, "superkingdom", "Archaea"),
+    (3001, 2157, "phylum", "Synthetic archaea"),
+    (30010, 3001, "genus", "Synthar"),
+    (300101, 30010, "species", "Synthar delta"),
+    (2759, 131567, "superkingdom", "Eukaryota"),
+    (4751, 2759, "kingdom", "Fungi"),
+    (4001, 4751, "phylum", "Synthetic fungi"),
+    (40010, 4001, "genus", "Synthomyces"),
+    (400101, 40010, "species", "Synthomyces epsilon"),
+    (400102, 40010, "species", "Synthomyces zeta"),
+    (40020, 4001, "genus", "Fakeomyces"),
+    (400201, 40020, "species", "Fakeomyces eta"),
+]
+MODEL_TAXA = [400101, 400102, 400201, 40010, 40020, 4001, 4751]
+
+
+def write_genome(path, size, gc=0.5, seed=0, minlength=5000, maxlength=50000):
+    """write a random genome of about size bp, cut into contigs"""
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    p = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+    prefix = os.path.basename(path).split(".")[0]
+    written = 0
+    with open(path, "w") as fout:
+        i = 0
+        while written < size:
+            length = int(min(rng.integers(minlength, maxlength + 1), max(minlength, size - written)))
+            seq = rng.choice(bases, size=length, p=p).tobytes().decode()
+            fout.write(">{}_ctg{} length={}\n".format(prefix, i, length))
+            for start in range(0, length, 60):
+                end = start + 60
+                fout.write(seq[start:end])
+                fout.write("\n")
+            written += length
+            i += 1
+    return path
+
+
+def kinds(count):
+    """kinds of count bins: 40% bacterial, 50% eukaryotic and 10% eukaryotic without self training"""
+    pattern = ["bac"] * 4 + ["euk"] * 5 + ["euknotrain"]
+    return [pattern[i % len(pattern)] for i in range(count)]
+
+
+def write_bins(folder, count, size, seed=0):
+    """write count bins of about size bp each, returns their paths"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, kind in enumerate(kinds(count)):
+        path = os.path.join(folder, "{}{:04d}.fa".format(kind, i))
+        if not os.path.exists(path):
+            write_genome(path, size, GC[kind], seed=seed + i)
+        paths.append(path)
+    return paths
+
+
+def write_synthetic_taxonomy(path):
+    write_taxonomy(path, TAXONOMY)
+    return path
+
+
+def write_database(path):
+    """the stand-in diamond does not read the database, it only has to exist"""
+    with open(path, "wb"):
+        pass
+    return path
+
+
+def write_model_mirror(folder, nmodels=20):
+    """
+    write a mirror of pretrained models, laid out like the public one
+    (info.csv and models/<name>.mod.gz). Like the public mirror, it
+    also lists the models shipped with pygmes. Returns its file:// url
+    """
+    os.makedirs(os.path.join(folder, "models"), exist_ok=True)
+    models = []
+    for path in sorted(glob.glob(os.path.join(root, "pygmes", "data", "models", "*.mod"))):
+        with open(path, "rb") as fin:
+            models.append((os.path.basename(path)[:-4], fin.read()))
+    for i in range(nmodels):
+        name = "GCA_9{:08d}.1".format(i)
+        models.append((name, "# synthetic model {}\n".format(name).encode()))
+    lines = []
+    for i, (name, data) in enumerate(models):
+        taxid = MODEL_TAXA[i % len(MODEL_TAXA)]
+        with gzip.open(os.path.join(folder, "models", "{}.mod.gz".format(name)), "wb") as fout:
+            fout.write(data)
+        lines.append("{},{},{}".format(name, taxid, hashlib.sha256(data).hexdigest()))
+    with open(os.path.join(folder, "info.csv"), "w") as fout:
+        fout.write("\n".join(lines) + "\n")
+    return "file://" + os.path.abspath(folder)
@@ -1,33 +1,118 @@
 import os
 import logging
 import argparse
-from collections import defaultdict
 from pygmes.exec import gmes, multistep_gmes
 from pygmes.diamond import multidiamond
 import pygmes.version as version
 from pygmes.exec import create_dir, check_dependencies
 from pygmes.printlngs import write_lngs
 from pygmes.prodigal import prodigal
+from pygmes.parallel import cores_for_size
+from pygmes.pipeline import dag
+from pygmes.models import set_modelstore
+from pygmes.resultcache import set_resultcache
+from pygmes.fasta import proteome_stats, read_fasta, fastawriter, record_name, open_fasta, rewrite_headers
+from pygmes.fasta import uncompressed_size
+from pygmes.manifest import manifest, atomic_output, atomic_copy
+from pygmes.timings import set_timings, get_timings, stage
+from pygmes.progress import set_progress
 import shutil
-import gzip
 from glob import glob
-from pyfaidx import Fasta
 
 path = os.path.abspath(os.path.dirname(__file__))
 MODELS_PATH = os.path.join(path, "data", "models")
 
 
+def single_fasta(fastas, names, output, sep="_"):
+    """make a single file for CAT, including a prefix so CAT will not get confused"""
+    if len(fastas) != len(names):
+        logging.warning("Number of Fastas does not match names")
+        exit(1)
+    nseqs = 0
+    with atomic_output(output) as tmp, open(tmp, "w") as fout:
+        for fasta, name in zip(fastas, names):
+            with open(fasta) as fin:
+                for line in fin:
+                    if line.startswith(">"):
+                        line = line.strip().split()[0][1:]
+                        line = ">{}{}{}\n".format(name, sep, line)
+                        nseqs += 1
+                    fout.write(line)
+    if nseqs == 0:
+        logging.warning("No sequence in aggregate")
+        exit(1)
+
+
+def warn_single_core(ncores):
+    if ncores == 1:
+        logging.warning(
+            "You are running GeneMark-ES with a single core. This will be slow. We recommend using 4-8 cores."
+        )
+
+
 class bin:
     def __init__(self, path, outdir):
         self.fasta = os.path.abspath(path)
         self.name = os.path.basename(path)
+        # gzipped bins are cleaned into uncompressed files, named without the .gz
+        if self.name.endswith(".gz"):
+            self.name = self.name[:-3]
         self.outdir = os.path.join(os.path.abspath(outdir), self.name)
         create_dir(self.outdir)
         self.hybridfaa = None
+        self.kingdom = None
+        self.first_lng_estimation = None
+
+    def __str__(self):
+        return self.name
+
+    def set_lineage(self, lng):
+        """use the lineage estimation lng and assign a taxonomic kingdom based on it"""
+        self.first_lng_estimation = lng
+        if 2 in lng["lng"]:
+            self.kingdom = "bacteria"
+        elif 2759 in lng["lng"]:
+            self.kingdom = "eukaryote"
+        elif 2157 in lng["lng"]:
+            self.kingdom = "archaea"
+
+    def state(self):
+        """what is known about the bin, to continue with it in a later run (see restore)"""
+        state = {
+            "fasta": self.fasta,
+            "kingdom": self.kingdom,
+            "first_lng_estimation": self.first_lng_estimation,
+            "hybridfaa": self.hybridfaa,
+            "hybridbed": getattr(self, "hybridbed", None),
+            "prodigal": self.prodigal.outdir if hasattr(self, "prodigal") else None,
+            "gmes": self.gmes.state() if hasattr(self, "gmes") else None,
+        }
+        for key in ["software", "metadata", "finalfaa", "finalbed"]:
+            if hasattr(self, key):
+                state[key] = getattr(self, key)
+        return state
+
+    def restore(self, state):
+        self.fasta = state["fasta"]
+        self.kingdom = state["kingdom"]
+        self.first_lng_estimation = state["first_lng_estimation"]
+        self.hybridfaa = state["hybridfaa"]
+        self.hybridbed = state["hybridbed"]
+        if state["prodigal"] is not None:
+            self.prodigal = prodigal(self.fasta, state["prodigal"], run=False, name=self.name)
+        if state["gmes"] is not None:
+            self.gmes = gmes.from_state(state["gmes"])
+        for key in ["software", "metadata", "finalfaa", "finalbed"]:
+            if key in state:
+                setattr(self, key, state[key])
+
+    def needs_gmes(self):
+        # bins that are euakryotic or could not be assigned a lineage
+        return self.kingdom is None or self.kingdom == "eukaryote"
 
     def get_best_faa(self):
         if self.kingdom is not None and self.kingdom in ["bacteria", "archaea"]:
-            if self.prodigal.check_success():
+            if self.prodigal_success():
                 return (self.prodigal.faa, self.prodigal.bed, self.name, "prodigal")
         elif hasattr(self, "gmes") and self.gmes.check_success():
             # check if we made a hybrid
@@ -39,7 +124,7 @@ class bin:
             # this bin is euakryotic maybe, but gmes has failed.
             # so we will return the prodigal peptides instead, eeventhough we
             # know this might be of low quality
-            if self.prodigal.check_success():
+            if self.prodigal_success():
                 return (self.prodigal.faa, self.prodigal.bed, self.name, "prodigal")
         # default to none, as we dont have proteins it seems
         logging.debug("No final faa for bin: %s" % self.name)
@@ -47,19 +132,25 @@ class bin:
 
     def gmes_training(self, ncores=1):
         outdir = os.path.join(self.outdir, "gmes_training")
-        self.gmes = gmes(self.fasta, outdir, ncores)
+        self.gmes = gmes(self.fasta, outdir, ncores, name=self.name)
         self.gmes.selftraining()
 
     def run_prodigal(self, ncores=1, outdir=None):
         if outdir is None:
             outdir = os.path.join(self.outdir, "prodigal")
             create_dir(outdir)
-        self.prodigal = prodigal(self.fasta, outdir, ncores)
+        self.prodigal = prodigal(self.fasta, outdir, ncores, name=self.name)
+
+    def prodigal_success(self):
+        # prodigal can be missing if the run crashed in the pool
+        if not hasattr(self, "prodigal"):
+            return False
+        return self.prodigal.check_success()
 
     def make_hybrid_faa(self, gmesfirst=True):
         logging.debug("Making a hybrid of bin %s" % self.name)
         try:
-            if not self.gmes.check_success() or not self.prodigal.check_success():
+            if not self.gmes.check_success() or not self.prodigal_success():
                 return
         except AttributeError:
             return
@@ -71,25 +162,20 @@ class bin:
         def sane_faa(faa):
             if os.stat(faa).st_size == 0:
                 return False
-            try:
-                fa = Fasta(faa)
-                if len(fa.keys()) > 0:
-                    return fa
-                return False
-            except Exception as e:
-                print(e)
+            if proteome_stats(faa)["proteins"] == 0:
                 logging.debug("Fasta has no entries: %s" % faa)
                 return False
+            return True
 
         def chromname(s):
             if s.startswith(">"):
                 s = s[1:]
             return s.strip().split()[0].rsplit("_", 1)[0]
 
-        def getchroms(fa):
+        def getchroms(faa):
             contigs = set()
-            for seq in fa:
-                contigs.add(chromname(seq.name))
+            for header, seq in read_fasta(faa):
+                contigs.add(chromname(record_name(header)))
             return contigs
 
         if gmesfirst:
@@ -102,34 +188,35 @@ class bin:
             faa1 = self.prodigal.faa
             bed2 = self.gmes.bedfile
             bed1 = self.prodigal.bed
-        # load and check for valid fastas
-        fa1 = sane_faa(faa1)
-        fa2 = sane_faa(faa2)
-        if fa1 is False or fa2 is False:
+        # check for valid fastas
+        if not sane_faa(faa1) or not sane_faa(faa2):
             return faa1
 
         # find contigs uniqly annotated in faa2
-        contigs1 = getchroms(fa1)
-        contigs2 = getchroms(fa2)
+        contigs1 = getchroms(faa1)
+        contigs2 = getchroms(faa2)
         leftover = contigs2 - contigs1
         if len(leftover) > 0:
             logging.debug("We found possible bacterial proteins in this proteome")
-            # write prot from fa1
-            with open(self.hybridfaa, "w") as fout:
-                for seq in fa1:
-                    fout.write(f">{seq.name}\n{seq}\n")
-                # add new from fa2
-                for seq in fa2:
-                    # write to file
-                    if chromname(seq.name) in leftover:
-                        fout.write(f">{seq.name}\n{seq}\n")
+            # make a merged bedfile first, as the faa marks a finished hybrid
+            with atomic_output(self.hybridbed) as tmp, open(tmp, "w") as fout:
+                with open(bed1) as fin:
+                    shutil.copyfileobj(fin, fout)
+                with open(bed2) as fin:
+                    for line in fin:
+                        if line.split("\t")[0] in leftover:
+                            fout.write(line)
 
-            # make a merged bedfile
-            shutil.copy(bed1, self.hybridbed)
-            with open(self.hybridbed, "a") as fout, open(bed2) as fin:
-                for line in fin:
-                    if line.split("\t")[0] in leftover:
-                        fout.write(line)
+            # write prot from faa1
+            with atomic_output(self.hybridfaa) as tmp, fastawriter(tmp) as fout:
+                for header, seq in read_fasta(faa1):
+                    fout.write(record_name(header), seq)
+                # add new from faa2
+                for header, seq in read_fasta(faa2):
+                    # write to file
+                    name = record_name(header)
+                    if chromname(name) in leftover:
+                        fout.write(name, seq)
 
 
 class pygmes:
@@ -150,6 +237,8 @@ class pygmes:
     """
 
     def __init__(self, fasta, outdir, db, clean=True, ncores=1, cleanup=False):
+        set_timings()
+        warn_single_core(ncores)
         self.fasta = fasta
         self.outdir = outdir
         self.ncores = ncores
@@ -167,10 +256,17 @@ class pygmes:
         ms = multistep_gmes(self.cleanfasta, outdir, ncores, db, MODELS_PATH)
         if cleanup and ms.success is True:
             ms.cleanup()
-
-    def clean_fasta(self, fastaIn, folder, rename=True):
+        get_timings().write(outdir)
+
+    def clean_fasta(self, fastaIn, folder, rename=True, reuse=True, mappingfile=None):
+        """
+        write fastaIn to folder with unique record names, the first word of each header.
+        The old and new names are written to mappingfile, by default mapping.csv in folder.
+        Gzipped input is written uncompressed, without the .gz
+        """
         create_dir(folder)
-        name = os.path.basename(fastaIn)
+        label = os.path.basename(fastaIn)
+        name = label[:-3] if label.endswith(".gz") else label
         if rename:
             fastaOut = os.path.join(folder, "gmesclean_{}".format(name))
         else:
@@ -179,47 +275,19 @@ class pygmes:
             logging.error("Name collision, please do not use the same folder for input and output")
             exit(1)
 
-        if os.path.exists(fastaOut):
+        if reuse and os.path.exists(fastaOut):
             logging.warning(
                 "Clean fasta file %s already exists, this could be from a previous run or an file name issue!" % name
             )
             return fastaOut
-        mappingfile = os.path.join(folder, "mapping.csv")
+        if mappingfile is None:
+            mappingfile = os.path.join(folder, "mapping.csv")
         logging.debug("Cleaning fasta file")
-        nms = defaultdict(int)
-        with open(fastaOut, "w") as o, open(mappingfile, "w") as mo:
-            mo.write("old,new\n")
-            if fastaIn.endswith(".gz"):
-                openMethod = gzip.open
-                gz = True
-                logging.debug("reading gzipped file")
-            else:
-                openMethod = open
-                gz = False
-            # read in the fasta
-            with openMethod(fastaIn) as f:
-                for line in f:
-                    if gz:
-                        line = line.decode()
-                    if line.startswith(">"):
-                        line = line.strip()
-                        l = line.split()
-                        # get first element, usually a chromosome
-                        N = l[0].strip()
-                        # while the name is already taken, count up and reformat
-                        n = "{}.{}".format(N, nms[N])
-                        # if the name is already taken, count up and reformat
-                        if nms[N] != 0:
-                            n = "{}.{}".format(N, nms[N])
-                        else:
-                            n = N
-                        nms[N] += 1
-
-                        o.write("{}\n".format(n))
-                        mappingline = "{},{}\n".format(line, n).replace(">", "")
-                        mo.write(mappingline)
-                    else:
-                        o.write(line)
+        # the clean fasta and the mapping are only put in place once complete
+        with stage("clean", bin=label), atomic_output(fastaOut) as tmp, atomic_output(mappingfile) as maptmp:
+            with open(tmp, "wb") as fout, open(maptmp, "wb") as mapping, open_fasta(fastaIn) as fin:
+                mapping.write(b"old,new\n")
+                rewrite_headers(fin, fout, mapping)
         return fastaOut
 
 
@@ -234,19 +302,49 @@ class metapygmes(pygmes):
     number of AA. We then infer the lineage of each bin
     """
 
-    def __init__(self, bindir, outdir, db, clean=True, ncores=1, infertaxonomy=True, fill_bac_gaps=True):
+    def __init__(
+        self,
+        bindir,
+        outdir,
+        db,
+        clean=True,
+        ncores=1,
+        infertaxonomy=True,
+        fill_bac_gaps=True,
+        screen=3,
+        adaptive=False,
+        diamond_options=None,
+        batchwait=None,
+        resume=True,
+        progress=None,
+    ):
+        set_timings()
+        # small bins get a single core from the scheduler, only a single core in total is worth a warning
+        warn_single_core(ncores)
+        # events for a workflow manager, written to the file or FIFO progress
+        events = set_progress(progress)
+        # vote weighting and resources of diamond, passed on to multidiamond
+        if diamond_options is None:
+            diamond_options = {}
         # find all files and
         outdir = os.path.abspath(outdir)
         self.outdir = outdir
         bindir = os.path.abspath(bindir)
-        fa = glob(os.path.join(bindir, "*.fa"))
-        fna = glob(os.path.join(bindir, "*.fna"))
-        fasta = glob(os.path.join(bindir, "*.fasta"))
-        files = fa + fna + fasta
+        files = []
+        for extension in ["fa", "fna", "fasta"]:
+            files += glob(os.path.join(bindir, "*.{}".format(extension)))
+            gzipped = glob(os.path.join(bindir, "*.{}.gz".format(extension)))
+            # only cleaning decompresses the bins, Prodigal and GeneMark-ES can not read gzip
+            if clean:
+                files += gzipped
+            elif len(gzipped) > 0:
+                logging.warning("Skipping %d gzipped bins, they are only read when cleaning" % len(gzipped))
         # prodigaldir = os.path.join(self.outdir, "prodigal")
         # convert all files to absolute paths
         files = [os.path.abspath(f) for f in files]
+        # gzipped bins are named without the .gz (see bin), as they are cleaned into uncompressed files
         names = [os.path.basename(f) for f in files]
+        names = [name[:-3] if name.endswith(".gz") else name for name in names]
         if len(names) != len(set(names)):
             logging.warning("Bin files need to have unique names")
             exit(1)
@@ -254,12 +352,6 @@ class metapygmes(pygmes):
         # outdirs = [os.path.join(outdir, name) for name in names]
         # proteinfiles = []
         # proteinnames = []
-        # if needed, we clean the fasta files
-
-        if clean:
-            logging.info("Cleaning input fastas")
-            cleanfastadir = os.path.join(outdir, "fasta_clean")
-            files = [self.clean_fasta(f, cleanfastadir, rename=False) for f in files]
 
         # bin list to keep all the bins and handle all the operations
         binlst = []
@@ -267,139 +359,250 @@ class metapygmes(pygmes):
         for path in files:
             binlst.append(bin(path, bindirs))
 
-        # run prodigal
-        logging.info("Running prodigal on all bins")
-        for b in binlst:
-            b.run_prodigal(ncores=ncores)
-
-        # now we can already get a first lineage estimation
-        # diamond is faster when using more sequences
-        # thus we pool all fasta together and seperate them afterwards
-        diamonddir = os.path.join(outdir, "diamond", "step_1")
-        create_dir(diamonddir)
-        logging.info("Predicting the lineage")
-        proteinfiles = [b.prodigal.faa for b in binlst if b.prodigal.check_success()]
-        proteinnames = [b.name for b in binlst if b.prodigal.check_success()]
-        dmnd_1 = multidiamond(proteinfiles, proteinnames, diamonddir, db=db, ncores=ncores)
-        logging.debug("Ran diamond and inferred lineages")
-        # assign a taxonomic kingdom based on the first lineage estimation
-        anyeuks = False
-        for b in binlst:
-            b.first_lng_estimation = None
-            b.kingdom = None
-            if b.name in dmnd_1.lngs.keys():
-                # as no lng was infered for this bin, we could try prodigal
-                b.first_lng_estimation = dmnd_1.lngs[b.name]
-                if 2 in b.first_lng_estimation["lng"]:
-                    b.kingdom = "bacteria"
-                elif 2759 in b.first_lng_estimation["lng"]:
-                    b.kingdom = "eukaryote"
-                    anyeuks = True
-                elif 2157 in b.first_lng_estimation["lng"]:
-                    b.kingdom = "archaea"
-                else:
-                    anyeuks = True
-
-        if anyeuks is False:
-            logging.info("All bins are prokaryotes, we can skip the GeneMark-ES steps")
-        else:
-            # for all bins that are euakryotic or could not be assigned a lineage,
-            # we try GeneMark-ES in a two step mode
-            modeldir = os.path.join(outdir, "gmes_models")
+        # finished steps are recorded in the manifest, so a restarted run
+        # continues with the unfinished ones
+        manifestfile = os.path.join(outdir, "manifest.jsonl")
+        if not resume and os.path.exists(manifestfile):
+            os.remove(manifestfile)
+        settings = {
+            "version": version.__version__,
+            "db": os.path.abspath(db),
+            "clean": clean,
+            "screen": screen,
+            "adaptive": adaptive,
+            "diamond": diamond_options,
+        }
+        journal = manifest(manifestfile, settings)
+
+        # each bin moves through the steps on its own: clean, prodigal,
+        # lineage, GeneMark-ES self training, pre models, hybrid, lineage
+        # and final output. Only diamond is run on many bins at once, as
+        # it is faster when using more sequences, and the pre models of a
+        # bin wait for the self training of all bins
+        pipeline = dag(ncores, journal=journal)
+        cleanfastadir = os.path.join(outdir, "fasta_clean")
+        modeldir = os.path.join(outdir, "gmes_models")
+        finaloutdir = os.path.join(self.outdir, "predicted_proteomes")
+        finalbeddir = os.path.join(finaloutdir, "bed")
+        if clean:
+            logging.info("Cleaning input fastas")
+            create_dir(cleanfastadir)
+        create_dir(finalbeddir)
+
+        def clean_bin(b):
+            # each bin has its own mapping, so bins are cleaned at the same time
+            mappingfile = os.path.join(cleanfastadir, "{}.mapping.csv".format(b.name))
+            b.fasta = self.clean_fasta(b.fasta, cleanfastadir, rename=False, reuse=False, mappingfile=mappingfile)
+
+        def run_prodigal(b):
+            b.run_prodigal()
+            return b.prodigal_success()
+
+        def lineage_step(step, faa):
+            # we pool all fasta together and seperate them afterwards
+            def run(cores, index, members):
+                diamonddir = os.path.join(outdir, "diamond", step if index == 1 else "{}_{}".format(step, index))
+                create_dir(diamonddir)
+                bins = [bins_by_name[name] for name in members.keys()]
+                proteinfiles = [faa(b) for b in bins]
+                proteinnames = [b.name for b in bins]
+                dmnd = multidiamond(
+                    proteinfiles,
+                    proteinnames,
+                    diamonddir,
+                    db=db,
+                    ncores=cores,
+                    adaptive=adaptive,
+                    **diamond_options,
+                )
+                for b in bins:
+                    if b.name in dmnd.lngs.keys():
+                        b.set_lineage(dmnd.lngs[b.name])
+                return members
+
+            return run
+
+        def trainedmodel(b):
+            return os.path.join(modeldir, "{}.mod".format(b.name))
+
+        def train(b, cores):
+            if not b.needs_gmes():
+                return False
+            logging.info("Running GeneMark-ES in self training on bin %s" % b.name)
             create_dir(modeldir)
-            nmodels = 0
-            logging.info("Running GeneMark-ES in self training")
-            for b in binlst:
-                if b.kingdom is None or b.kingdom == "eukaryote":
-                    # run self training
-                    b.gmes_training(ncores=ncores)
-                    expectedmodel = os.path.join(b.gmes.outdir, "output", "gmhmm.mod")
-                    if os.path.exists(expectedmodel):
-                        shutil.copy(expectedmodel, os.path.join(modeldir, "{}.mod".format(b.name)))
-                        nmodels += 1
-            # check if any bins were not predicted, if so we can use the models
-            # from other bins to get a better estimate
+            b.gmes_training(ncores=cores)
+            expectedmodel = os.path.join(b.gmes.outdir, "output", "gmhmm.mod")
+            if os.path.exists(expectedmodel):
+                atomic_copy(expectedmodel, trainedmodel(b))
+                return True
+            return False
+
+        def needs_premodel(b):
+            return b.needs_gmes() and hasattr(b, "gmes") and b.gmes.check_success() is False
+
+        def premodel(b):
+            # use the models from other bins to get a better estimate
             # if thats not possible, we could still run pygmes in non metagenomic
             # on each bin, but that should be decied by the user
-            if nmodels == 0:
+            if not needs_premodel(b):
+                return
+            if not any([pipeline.results.get("train:{}".format(x.name)) for x in binlst]):
                 logging.debug("No models were successfully trained")
-            else:
-                for b in binlst:
-                    if b.kingdom is None or b.kingdom == "eukaryote":
-                        if b.gmes.check_success() is False:
-                            b.gmes.premodel(modeldir)
-                            # if successfull, overwrite the gmes, with the successfull gmes
-                            if b.gmes.bestpremodel is not False and b.gmes.bestpremodel.check_success():
-                                b.gmes = b.gmes.bestpremodel
-            # now we have proteins predicted for all
-            # we can now give each bin the chance to merge prodigal and Gmes predictions
-            for b in binlst:
+                return
+            b.gmes.premodel(modeldir, stage="meta", screen=screen)
+            # if successfull, overwrite the gmes, with the successfull gmes
+            if b.gmes.bestpremodel is not False and b.gmes.bestpremodel.check_success():
+                b.gmes = b.gmes.bestpremodel
+
+        def hybrid(b):
+            # give each bin the chance to merge prodigal and Gmes predictions
+            with stage("hybrid", bin=b.name):
                 b.make_hybrid_faa()
+            # update the lineages using the new proteins
+            return b.needs_gmes() and b.get_best_faa()[0] is not None
 
-            # now we update the lineages using the new proteins
-            # and then we can create a final set of protein files
-            diamonddir = os.path.join(outdir, "diamond", "step_2")
-            create_dir(diamonddir)
-            proteinfiles = []
-            proteinnames = []
-            for b in binlst:
-                path, bedpath, name, software = b.get_best_faa()
-                if path is not None and b.kingdom not in ["bacteria", "archaea"]:
-                    proteinfiles.append(path)
-                    proteinnames.append(name)
-            if len(proteinfiles) > 0:
-                logging.info("Predicting the lineage using the results from GeneMark-ES")
-                dmnd_2 = multidiamond(proteinfiles, proteinnames, diamonddir, db=db, ncores=ncores)
-                for b in binlst:
-                    if b.name in dmnd_2.lngs.keys():
-                        # as no lng was infered for this bin, we could try prodigal
-                        b.first_lng_estimation = dmnd_2.lngs[b.name]
-                        if 2 in b.first_lng_estimation["lng"]:
-                            b.kingdom = "bacteria"
-                        elif 2759 in b.first_lng_estimation["lng"]:
-                            b.kingdom = "eukaryote"
-                        elif 2157 in b.first_lng_estimation["lng"]:
-                            b.kingdom = "archaea"
-            else:
-                logging.info("No changes after applying GeneMark-ES")
+        def finalize(b):
+            t = os.path.join(finaloutdir, "{}.faa".format(b.name))
+            bt = os.path.join(finalbeddir, "{}.bed".format(b.name))
+            path, bedpath, name, software = b.get_best_faa()
+            b.software = software
+            b.metadata = {"path": path, "software": software, "nprot": None, "lng": [], "name": b.name}
+            b.finalfaa = None
+            b.finalbed = None
+            if path is not None:
+                atomic_copy(path, t)
+                atomic_copy(bedpath, bt)
+                b.metadata["path"] = t
+                b.finalfaa = t
+                b.finalbed = bt
+                b.metadata["nprot"] = proteome_stats(t, cache=False)["proteins"]
+            if b.first_lng_estimation is not None:
+                b.metadata["lng"] = "-".join([str(x) for x in b.first_lng_estimation["lng"]])
+
+        def gmes_outputs(b):
+            return b.gmes.outputs() if hasattr(b, "gmes") else []
+
+        # output files of each step, their size is checked before a step is restored
+        outputs = {
+            "clean": lambda b, result: [b.fasta, inputs[b.name]],
+            "prodigal": lambda b, result: [b.fasta] + ([b.prodigal.faa, b.prodigal.bed] if result else []),
+            "train": lambda b, result: gmes_outputs(b) + ([trainedmodel(b)] if result else []),
+            "premodel": lambda b, result: gmes_outputs(b),
+            "hybrid": lambda b, result: [b.hybridfaa, b.hybridbed] if b.get_best_faa()[3] == "hybrid" else [],
+            "finalize": lambda b, result: [b.finalfaa, b.finalbed] if b.finalfaa else [],
+        }
+
+        def checkpoint(b, step):
+            return (lambda result: (b.state(), outputs[step](b, result)), b.restore)
+
+        def batch_checkpoint():
+            # lineage batches only change the state of the bins
+            def save(name, result):
+                return (bins_by_name[name].state(), [])
+
+            def restore(name, state):
+                bins_by_name[name].restore(state)
+
+            return (save, restore)
+
+        inputs = dict(zip(names, files))
+        bins_by_name = {b.name: b for b in binlst}
+        alltraining = ["train:{}".format(b.name) for b in binlst]
+        for b in binlst:
+            n = b.name
+            # gzipped bins are weighted by their size once decompressed
+            size = uncompressed_size(b.fasta)
+            deps = []
+            if clean:
+                pipeline.add("clean:" + n, lambda c, b=b: clean_bin(b), size=size, checkpoint=checkpoint(b, "clean"))
+                deps = ["clean:" + n]
+            pipeline.add(
+                "prodigal:" + n,
+                lambda c, b=b: run_prodigal(b),
+                deps=deps,
+                size=size,
+                checkpoint=checkpoint(b, "prodigal"),
+            )
+            # for all bins that are euakryotic or could not be assigned a lineage,
+            # we try GeneMark-ES in a two step mode. Large bins get more cores
+            pipeline.add(
+                "train:" + n,
+                lambda c, b=b: train(b, c),
+                deps=["lineage_1:" + n, "prodigal:" + n],
+                cores=lambda b=b, size=size: cores_for_size(size, ncores) if b.needs_gmes() else 0,
+                size=size,
+                checkpoint=checkpoint(b, "train"),
+            )
+            pipeline.add(
+                "premodel:" + n,
+                lambda c, b=b: premodel(b),
+                deps=["train:" + n],
+                lazydeps=lambda b=b: alltraining if needs_premodel(b) else [],
+                cores=lambda b=b: b.gmes.ncores if needs_premodel(b) else 0,
+                size=size,
+                checkpoint=checkpoint(b, "premodel"),
+            )
+            pipeline.add(
+                "hybrid:" + n,
+                lambda c, b=b: hybrid(b),
+                deps=["premodel:" + n],
+                size=size,
+                checkpoint=checkpoint(b, "hybrid"),
+            )
+            pipeline.add(
+                "finalize:" + n,
+                lambda c, b=b: finalize(b),
+                deps=["lineage_2:" + n],
+                size=size,
+                checkpoint=checkpoint(b, "finalize"),
+            )
+            # a bin is done once finalized, this is what the ETA is based on
+            events.track("finalize:" + n, n, size)
+        pipeline.add_batch(
+            "lineage_1",
+            lineage_step("step_1", lambda b: b.prodigal.faa),
+            {b.name: "prodigal:" + b.name for b in binlst},
+            cores=ncores,
+            wait=batchwait,
+            mincores=1 if batchwait is not None else None,
+            checkpoint=batch_checkpoint(),
+        )
+        pipeline.add_batch(
+            "lineage_2",
+            lineage_step("step_2", lambda b: b.get_best_faa()[0]),
+            {b.name: "hybrid:" + b.name for b in binlst},
+            cores=ncores,
+            wait=batchwait,
+            mincores=1 if batchwait is not None else None,
+            checkpoint=batch_checkpoint(),
+        )
+        logging.info("Running pygmes on %d bins" % len(binlst))
+        events.start(ncores=ncores, outdir=outdir)
+        results, failed = pipeline.run()
+        if len(failed) > 0:
+            logging.warning("%d steps failed: %s" % (len(failed), ", ".join(failed)))
 
         # now we can make a final FAA folder:
-        finaloutdir = os.path.join(self.outdir, "predicted_proteomes")
-        finalbeddir = os.path.join(finaloutdir, "bed")
-        create_dir(finaloutdir)
-        create_dir(finalbeddir)
         lngs = {}
         metadataf = os.path.join(self.outdir, "metadata.tsv")
         metadata = {}
         finalfaas = {}
         for b in binlst:
-            t = os.path.join(finaloutdir, "{}.faa".format(b.name))
-            bt = os.path.join(finalbeddir, "{}.bed".format(b.name))
-            path, bedpath, name, software = b.get_best_faa()
-            b.software = software
-            metadata[b.name] = {"path": path, "software": software, "nprot": None, "lng": [], "name": b.name}
-            if path is not None:
-                shutil.copy(path, t)
-                shutil.copy(bedpath, bt)
-                metadata[b.name]["path"] = t
-                finalfaas[b.name] = {"faa": t, "fasta": b.fasta}
-                try:
-                    fa = Fasta(t)
-                    metadata[b.name]["nprot"] = len(fa.keys())
-                except Exception as e:
-                    print(e)
-                    metadata[b.name]["nprot"] = 0
+            if not hasattr(b, "metadata"):
+                finalize(b)
+            metadata[b.name] = b.metadata
+            if b.finalfaa is not None:
+                finalfaas[b.name] = {"faa": b.finalfaa, "fasta": b.fasta}
             if b.first_lng_estimation is not None:
                 lngs[b.name] = {}
                 lngs[b.name]["lng"] = b.first_lng_estimation["lng"]
                 lngs[b.name]["n"] = b.first_lng_estimation["n"]
-                metadata[b.name]["lng"] = "-".join([str(x) for x in b.first_lng_estimation["lng"]])
         logging.debug("Copied files, now writing lineages")
         lngfile = os.path.join(outdir, "lineages.tsv")
         write_lngs(lngs, lngfile)
         # write metadata to disk
         logging.debug("Writing metadata")
-        with open(metadataf, "w") as fout:
+        with atomic_output(metadataf) as tmp, open(tmp, "w") as fout:
             keys = ["name", "path", "software", "nprot", "lng"]
             fout.write("\t".join(keys))
             fout.write("\n")
@@ -410,26 +613,7 @@ class metapygmes(pygmes):
                 fout.write("\t".join(l))
                 fout.write("\n")
 
-        # make a single file for CAT, including a prefix so CAT will not get confused
-        def single_fasta(fastas, names, output, sep="_"):
-            if len(fastas) != len(names):
-                logging.warning("Number of Fastas does not match names")
-                exit(1)
-            nseqs = 0
-            with open(output, "w") as fout:
-                for fasta, name in zip(fastas, names):
-                    with open(fasta) as fin:
-                        for line in fin:
-                            if line.startswith(">"):
-                                line = line.strip().split()[0][1:]
-                                line = ">{}{}{}\n".format(name, sep, line)
-                                nseqs += 1
-                            fout.write(line)
-            if nseqs == 0:
-                logging.warning("No sequence in aggregate")
-                exit(1)
-
-        # make massive protein file:
+        # make massive protein file, for CAT:
         catdir = os.path.join(outdir, "CAT")
         create_dir(catdir)
         catfaa = os.path.join(catdir, "cat.faa")
@@ -440,6 +624,9 @@ class metapygmes(pygmes):
         fnas = [finalfaas[name]["fasta"] for name in names]
         single_fasta(fnas, names, catfna)
         single_fasta(faas, names, catfaa)
+        get_timings().write(outdir)
+        events.end(failed=failed)
+        events.close()
 
         logging.info("Successfully ran pygmes --meta")
 
@@ -476,12 +663,114 @@ def main():
         help="Number of threads to use with GeneMark-ES and Diamond",
     )
     parser.add_argument("--meta", dest="meta", action="store_true", default=False, help="Run in metaegnomic mode")
+    parser.add_argument(
+        "--screen",
+        type=int,
+        required=False,
+        default=3,
+        help="In metagenomic mode, rank the models of other bins on a subsample of the contigs and only predict with the best n models on the whole bin. Set to 0 to predict with all models",
+    )
+    parser.add_argument(
+        "--adaptive-diamond",
+        dest="adaptive",
+        default=False,
+        action="store_true",
+        required=False,
+        help="In metagenomic mode, search the sampled proteins with Diamond in rounds and stop for each bin once its lineage is stable",
+    )
+    parser.add_argument(
+        "--batch-wait",
+        dest="batchwait",
+        type=float,
+        required=False,
+        default=None,
+        help="In metagenomic mode, start a pooled Diamond search at the latest this many seconds after the first bin is ready for it, instead of waiting for all bins",
+    )
+    parser.add_argument(
+        "--diamond-weight",
+        dest="diamond_weight",
+        type=str,
+        required=False,
+        default=None,
+        choices=["bitscore", "evalue"],
+        help="Weight the lineage votes of Diamond hits by their bitscore or -log10(evalue), instead of counting each hit once",
+    )
+    parser.add_argument(
+        "--diamond-shards",
+        dest="diamond_shards",
+        type=int,
+        required=False,
+        default=1,
+        help="Split the Diamond query into this many parts and search them at once, sharing the cores",
+    )
+    parser.add_argument(
+        "--diamond-block-size",
+        dest="diamond_blocksize",
+        type=float,
+        required=False,
+        default=None,
+        help="Block size (billions of letters) passed to Diamond with --block-size",
+    )
+    parser.add_argument(
+        "--diamond-index-chunks",
+        dest="diamond_indexchunks",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of index chunks passed to Diamond with --index-chunks",
+    )
+    parser.add_argument(
+        "--diamond-memory",
+        dest="diamond_memory",
+        type=float,
+        required=False,
+        default=None,
+        help="Maximum virtual memory (address space) of each Diamond process in GB. Unless set, the block size is chosen to fit",
+    )
     parser.add_argument(
         "--quiet", "-q", dest="quiet", action="store_true", default=False, help="Silcence most output",
     )
     parser.add_argument(
         "--debug", action="store_true", default=False, help="Debug and thus ignore safety",
     )
+    parser.add_argument(
+        "--no-cache",
+        dest="nocache",
+        default=False,
+        action="store_true",
+        required=False,
+        help="Do not reuse or store results of Prodigal, GeneMark-ES and Diamond in ~/.cache/pygmes/results",
+    )
+    parser.add_argument(
+        "--restart",
+        dest="resume",
+        default=True,
+        action="store_false",
+        required=False,
+        help="In metagenomic mode, start over instead of continuing the unfinished steps of an earlier run in the output folder",
+    )
+    parser.add_argument(
+        "--progress",
+        type=str,
+        required=False,
+        default=None,
+        help="In metagenomic mode, write progress events as JSON lines to this file or FIFO, including an ETA",
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        required=False,
+        default=None,
+        help="Folder to keep downloaded pretrained models in, defaults to ~/.cache/pygmes/models",
+    )
+    parser.add_argument(
+        "--models-url",
+        dest="models_url",
+        type=str,
+        required=False,
+        default=None,
+        help="url (ftp, http or file) or folder to fetch pretrained models from, for example a local mirror",
+    )
     parser.add_argument("-v", "--version", action="version", version=f"pygmes version {version.__version__}")
     options = parser.parse_args()
     create_dir(options.output)
@@ -499,6 +788,11 @@ def main():
         handlers=[logging.FileHandler(os.path.join(options.output, "pygmes.log")), logging.StreamHandler()],
     )
 
+    if options.nocache:
+        set_resultcache(enabled=False)
+    if options.models is not None or options.models_url is not None:
+        set_modelstore(options.models, options.models_url)
+
     # check for all dependencies
     dependencies = ["diamond", "prodigal", "gmes_petap.pl"]
     logging.debug("Checking dependencies")
@@ -525,4 +819,23 @@ def main():
             ncores=options.ncores,
         )
     else:
-        metapygmes(options.input, options.output, options.db, clean=options.noclean, ncores=options.ncores)
+        screen = options.screen if options.screen > 0 else None
+        metapygmes(
+            options.input,
+            options.output,
+            options.db,
+            clean=options.noclean,
+            ncores=options.ncores,
+            screen=screen,
+            adaptive=options.adaptive,
+            batchwait=options.batchwait,
+            resume=options.resume,
+            progress=options.progress,
+            diamond_options={
+                "weight": options.diamond_weight,
+                "shards": options.diamond_shards,
+                "blocksize": options.diamond_blocksize,
+                "indexchunks": options.diamond_indexchunks,
+                "memory": options.diamond_memory,
+            },
+        )
@@ -0,0 +1,11 @@
+import os
+
+
+def cache_dir(*parts):
+    """
+    folder for data pygmes keeps between runs, such as the taxonomy
+    snapshot. Defaults to ~/.cache/pygmes and can be changed with the
+    environment variable PYGMES_CACHE
+    """
+    root = os.environ.get("PYGMES_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pygmes"))
+    return os.path.join(root, *parts)
@@ -0,0 +1,77 @@
+from itertools import chain
+import numpy as np
+
+
+def consensus(groups, fraction=0.6, weights=None):
+    """
+    majority lineage of many groups of lineages at once.
+
+    Each group is a list of lineages (lists of taxids). At every depth,
+    the most common taxid is kept as long as its share of all lineages
+    of the group is at least fraction. Ties go to the taxid seen first.
+    If weights is given (one list of weights per group), each lineage
+    counts with its weight instead of once.
+
+    All lineages are flattened into arrays of (group, depth, taxid) and
+    counted with a single sort, instead of counting each group and
+    depth on its own. Returns one lineage per group.
+    """
+    ngroups = len(groups)
+    if ngroups == 0:
+        return []
+    glens = np.fromiter((len(g) for g in groups), dtype=np.int64, count=ngroups)
+    lens = np.fromiter((len(l) for g in groups for l in g), dtype=np.int64, count=int(glens.sum()))
+    if weights is None:
+        lweights = np.ones(len(lens))
+    else:
+        lweights = np.fromiter(chain.from_iterable(weights), dtype=np.float64, count=len(lens))
+    lgroup = np.repeat(np.arange(ngroups), glens)
+    total = np.bincount(lgroup, weights=lweights, minlength=ngroups)
+    nvalues = int(lens.sum())
+    if nvalues == 0:
+        return [[] for g in groups]
+
+    # one entry per taxid of every lineage
+    values = np.fromiter(chain.from_iterable(chain.from_iterable(groups)), dtype=np.int64, count=nvalues)
+    lineage = np.repeat(np.arange(len(lens)), lens)
+    depth = np.arange(nvalues) - np.repeat(np.cumsum(lens) - lens, lens)
+    group = lgroup[lineage]
+
+    # count each taxid per group and depth. Sorting on a single integer
+    # key is stable, so within a run the first lineage having it comes first
+    maxdepth = int(lens.max())
+    bits = max(1, int(values.max()).bit_length())
+    if values.min() >= 0 and (ngroups * maxdepth).bit_length() + bits < 63:
+        order = np.argsort(((group * maxdepth + depth) << bits) | values, kind="stable")
+    else:
+        order = np.lexsort((lineage, values, depth, group))
+    group = group[order]
+    depth = depth[order]
+    values = values[order]
+    lineage = lineage[order]
+    segment = np.concatenate([[True], (group[1:] != group[:-1]) | (depth[1:] != depth[:-1])])
+    starts = np.flatnonzero(segment | np.concatenate([[True], values[1:] != values[:-1]]))
+    counts = np.add.reduceat(lweights[lineage], starts)
+    first = lineage[starts]
+    group = group[starts]
+    values = values[starts]
+
+    # the best taxid of each group and depth: the most votes, then seen first
+    segstarts = np.flatnonzero(segment[starts])
+    segment = np.cumsum(segment[starts]) - 1
+    candidate = counts == np.maximum.reduceat(counts, segstarts)[segment]
+    first = np.where(candidate, first, len(lens))
+    best = np.flatnonzero(candidate & (first == np.minimum.reduceat(first, segstarts)[segment]))
+    group = group[best]
+    values = values[best]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        failed = ~(counts[best] / total[group] >= fraction)
+
+    # keep the depths of each group up to the first one without a majority
+    nfailed = np.cumsum(failed)
+    groupstart = np.flatnonzero(np.concatenate([[True], group[1:] != group[:-1]]))
+    before = np.repeat(nfailed[groupstart] - failed[groupstart], np.diff(np.append(groupstart, len(group))))
+    keep = nfailed == before
+    ends = np.cumsum(np.bincount(group[keep], minlength=ngroups)).tolist()
+    values = values[keep].tolist()
+    return [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
@@ -1,47 +1,85 @@
+import hashlib
 import logging
 import os
+import random
+import resource
+import shutil
 import subprocess
-from pyfaidx import Fasta
-from random import sample
-from collections import defaultdict
-from ete3 import NCBITaxa
+import numpy as np
+from pygmes.taxonomy import get_taxonomy
+from pygmes.resultcache import get_resultcache
+from pygmes.hitcache import get_hitcache, sequence_hash
+from pygmes.fasta import read_fasta, fastawriter, record_name
+from pygmes.parallel import run_parallel, run_command
+from pygmes.timings import get_timings, stage, mark
+from pygmes.consensus import consensus
+from pygmes.hittable import hittable
 
 
 def majorityvote(lngs, fraction=0.6):
     if fraction <= 0.5:
         logging.warning("fraction must be larger than 0.5")
-    if len(lngs) == 0:
+    return consensus([lngs], fraction)[0]
+
+
+def bin_rng(name):
+    """random generator seeded from the bin name, so sampling does not depend on the order of bins"""
+    digest = hashlib.sha256("4145421:{}".format(name).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def database_file(db):
+    """the file diamond reads for db, which can be given without its .dmnd suffix"""
+    for path in [db, db + ".dmnd"]:
+        if os.path.isfile(path):
+            return path
+    return db
+
+
+def sample_proteins(faa, n, rng):
+    """
+    draw n proteins from a fasta file in one pass (reservoir sampling),
+    returned as (name, sequence) in the order of the file
+    """
+    if not os.path.exists(faa) or os.stat(faa).st_size == 0:
+        logging.warning(
+            "Could not read the faa file as it probably \n contains no sequence information. \n Check file: %s " % faa
+        )
         return []
-    ml = max([len(v) for v in lngs])
-    i = 0
-    n = len(lngs)
-
-    lng = []
-    while i < ml:
-        choices = defaultdict(int)
-        for l in lngs:
-            if len(l) <= i:
-                continue
-            choices[l[i]] += 1
-        # decide if this is majority material
-        if len(choices) > 0:
-            best = max(choices, key=lambda key: choices[key])
-            if choices[best] / n >= fraction:
-                lng.append(best)
-            else:
-                break
-            i += 1
+    reservoir = []
+    for i, (header, seq) in enumerate(read_fasta(faa)):
+        if i < n:
+            reservoir.append((i, header, seq))
         else:
-            break
-    return lng
+            j = rng.randint(0, i)
+            if j < n:
+                reservoir[j] = (i, header, seq)
+    reservoir.sort(key=lambda x: x[0])
+    return [(record_name(header), seq) for i, header, seq in reservoir]
 
 
 class diamond:
-    def __init__(self, faa, outdir, db, ncores=1, sample=100):
+    def __init__(
+        self,
+        faa,
+        outdir,
+        db,
+        ncores=1,
+        sample=100,
+        fraction=0.6,
+        weight=None,
+        shards=1,
+        blocksize=None,
+        indexchunks=None,
+        memory=None,
+    ):
         self.faa = faa
+        self.fraction = fraction
+        self.weight = weight
         self.outdir = outdir
         self.db = db
         self.ncores = ncores
+        self.set_resources(shards, blocksize, indexchunks, memory)
         self.outfile = os.path.join(self.outdir, "diamond.results.tsv")
         self.log = os.path.join(self.outdir, "diamond.log")
         self.lineages = {}
@@ -61,104 +99,260 @@ class diamond:
         self.parse_results(self.outfile)
         # infer lineages
         logging.debug("Inferring the lineage")
-        proteinlngs = self.lineage_infer_protein(self.result)
-        self.lineage = self.vote_bin(proteinlngs)
+        with stage("lineage_vote"):
+            proteinlngs, best = self.lineage_infer_proteins(self.result)
+            lngs, counts = self.vote(self.result, proteinlngs, best)
+        self.lineage = lngs[0] if len(lngs) > 0 else []
         logging.debug("Finished the diamond step")
 
+    args = [
+        "blastp",
+        "--evalue",
+        str(1e-20),
+        "--max-target-seqs",
+        "3",
+        "--outfmt",
+        "6",
+        "qseqid",
+        "sseqid",
+        "pident",
+        "evalue",
+        "bitscore",
+        "staxids",
+    ]
+
+    def set_resources(self, shards=1, blocksize=None, indexchunks=None, memory=None):
+        """
+        shards is the number of diamond processes the query is split
+        between, blocksize and indexchunks are passed on to diamond.
+        memory caps the virtual memory (address space, not resident
+        memory) of each diamond process in GB, if no blocksize is given
+        it is chosen to fit into that cap
+        """
+        self.shards = max(1, shards)
+        self.indexchunks = indexchunks
+        self.memory = memory
+        if blocksize is None and memory is not None:
+            # diamond uses about six times the block size in GB
+            blocksize = max(0.1, int(memory / 6 * 10) / 10)
+        self.blocksize = blocksize
+
+    def run_diamond(self, outfile, query, ncores, log):
+        """run diamond blastp once, returns True on success"""
+        lst = ["diamond"] + self.args + ["--db", self.db, "-q", query, "-p", str(ncores), "-o", outfile]
+        if self.blocksize is not None:
+            lst += ["--block-size", str(self.blocksize)]
+        if self.indexchunks is not None:
+            lst += ["--index-chunks", str(self.indexchunks)]
+        limits = None
+        if self.memory is not None:
+            limits = {resource.RLIMIT_AS: int(self.memory * (1 << 30))}
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        try:
+            with open(log, "w") as fout:
+                run_command(lst, log=fout, shell=False, limits=limits)
+        except subprocess.CalledProcessError as e:
+            # a crashed or killed diamond can leave a partial output
+            logging.warning("Diamond failed with exit code %d, see %s" % (e.returncode, log))
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            return False
+        if not os.path.exists(outfile):
+            logging.warning("Diamond failed, see %s" % log)
+            return False
+        return True
+
+    def split_query(self, query, n):
+        """split the query into at most n files with about the same number of residues"""
+        records = list(read_fasta(query))
+        total = sum([len(seq) for header, seq in records])
+        base = os.path.splitext(query)[0]
+        shards = []
+        fout = None
+        size = 0
+        for header, seq in records:
+            if fout is None or (size >= total * len(shards) / n and len(shards) < n):
+                if fout is not None:
+                    fout.close()
+                shards.append("{}.shard{}.faa".format(base, len(shards) + 1))
+                fout = fastawriter(shards[-1])
+            fout.write(header, seq)
+            size += len(seq)
+        if fout is not None:
+            fout.close()
+        return shards
+
+    def search_shards(self, outfile, query):
+        """run diamond on shards of the query at once and merge the results into outfile"""
+        shards = self.split_query(query, self.shards)
+        cores = max(1, self.ncores // max(1, len(shards)))
+        logging.debug("Running diamond on %d shards with %d cores each" % (len(shards), cores))
+        base = os.path.splitext(self.log)[0]
+        jobs = [
+            (shard, "{}.{}".format(outfile, i + 1), "{}.shard{}.log".format(base, i + 1))
+            for i, shard in enumerate(shards)
+        ]
+        # the shards count towards the diamond stage of this thread
+        timings = get_timings()
+        record = timings.current()
+
+        def run(job):
+            with timings.attach(record):
+                return self.run_diamond(job[1], job[0], cores, job[2])
+
+        results, failed = run_parallel(run, jobs, len(jobs), label="diamond shard")
+        success = len(failed) == 0 and all(results.values())
+        if success:
+            with open(outfile, "wb") as fout:
+                for shard, shardout, log in jobs:
+                    with open(shardout, "rb") as fin:
+                        shutil.copyfileobj(fin, fout)
+        for shard, shardout, log in jobs:
+            for f in [shard, shardout]:
+                if os.path.exists(f):
+                    os.remove(f)
+        return success
+
     def search(self, outfile, query):
-        if not os.path.exists(outfile) or os.stat(outfile).st_size == 0:
+        """run diamond on query, or restore its output from the result cache. Returns True on success"""
+        args = self.args
+        cache = get_resultcache()
+        key = cache.key("diamond", args, [query], [database_file(self.db)])
+        outdir, name = os.path.split(os.path.abspath(outfile))
+        with stage("diamond", cores=self.ncores):
+            if cache.restore(key, outdir, [name]) == "ok":
+                logging.info("Diamond output already exists ")
+                logging.debug("AT: %s" % outfile)
+                mark("cached")
+                return True
             logging.info("Running diamond now")
-            lst = [
-                "diamond",
-                "blastp",
-                "--db",
-                self.db,
-                "-q",
-                query,
-                "-p",
-                str(self.ncores),
-                "--evalue",
-                str(1e-20),
-                "--max-target-seqs",
-                "3",
-                "--outfmt",
-                "6",
-                "qseqid",
-                "sseqid",
-                "pident",
-                "evalue",
-                "bitscore",
-                "staxids",
-                "-o",
-                outfile,
-            ]
-            with open(self.log, "w") as fout:
-                subprocess.run(lst, stderr=fout, stdout=fout)
-            logging.debug("Ran diamond")
-        else:
-            logging.info("Diamond output already exists ")
-            logging.debug("AT: %s" % outfile)
+            if self.shards > 1:
+                success = self.search_shards(outfile, query)
+            else:
+                success = self.run_diamond(outfile, query, self.ncores, self.log)
+            if not success:
+                mark("failed")
+                return False
+            cache.store(key, outdir, [name])
+        logging.debug("Ran diamond")
+        return True
 
     def sample(self, output, n=200):
         logging.debug("Sampeling %d proteins from %s" % (n, self.faa))
-        try:
-            faa = Fasta(self.faa)
-        except ZeroDivisionError:
-            logging.warning(
-                "Could not read the faa file as it probably \n contains no sequence information. \n Check file: %s "
-                % self.faa
-            )
-            return 0
-        except Exception as e:
-            print(e)
-            return 0
-
-        keys = faa.keys()
-        if len(keys) > n:
-            keys = sample(keys, n)
-        with open(output, "a") as fout:
-            for k in keys:
-                fout.write(f">{k}\n{str(faa[k])}\n")
+        records = sample_proteins(self.faa, n, bin_rng(os.path.basename(self.faa)))
+        with fastawriter(output, "w") as fout:
+            for name, seq in records:
+                fout.write(name, seq)
 
     def parse_results(self, result):
-        r = defaultdict(list)
-        with open(result) as f:
-            for line in f:
-                l = line.strip().split("\t")
-                r[l[0]].append(l[5])
-        self.result = r
+        self.result = hittable().read(result)
 
     def inferlineage(self, tax):
+        """
+        lineage of a staxids value. If it lists several taxids
+        (123;456), the lineage of their last common ancestor
+        """
         if tax in self.lineages.keys():
             return self.lineages[tax]
-        else:
-            ncbi = NCBITaxa()
+        lngs = []
+        for taxid in tax.split(";"):
+            if len(taxid) == 0:
+                continue
             try:
-                self.lineages[tax] = ncbi.get_lineage(tax)
-                return self.lineages[tax]
+                lngs.append(get_taxonomy().get_lineage(taxid))
             except ValueError:
-                print(f"Not able to fetch lineage for taxid {tax}")
-                return []
+                print(f"Not able to fetch lineage for taxid {taxid}")
+        lng = []
+        if len(lngs) > 0:
+            for taxids in zip(*lngs):
+                if any([t != taxids[0] for t in taxids]):
+                    break
+                lng.append(taxids[0])
+        self.lineages[tax] = lng
+        return lng
+
+    def hit_weights(self, evalue, bitscore):
+        """weight of the vote of each hit"""
+        if self.weight == "bitscore":
+            return bitscore.astype(np.float64)
+        if self.weight == "evalue":
+            return np.minimum(300.0, -np.log10(np.maximum(evalue, 1e-300)))
+        return np.ones(len(evalue))
 
-    def lineage_infer_protein(self, result):
-        prot = {}
-        for protein, taxids in result.items():
-            lngs = []
-            for taxid in taxids:
-                l = self.inferlineage(taxid)
-                if len(l) > 0:
-                    lngs.append(l)
+    def lineage_infer_proteins(self, table):
+        """
+        lineage of every protein of a hit table, voted on all at once.
+        Returns the lineages and the weight of the best hit of each protein
+        """
+        hits = table.columns()
+        nprot = len(table.proteins)
+        if nprot == 0:
+            return [], np.zeros(0)
+        weights = self.hit_weights(hits["evalue"], hits["bitscore"])
+        best = np.full(nprot, -np.inf)
+        np.maximum.at(best, hits["protein"], weights)
 
-            prot[protein] = majorityvote(lngs)
-        return prot
+        # each distinct taxon is looked up once, hits without lineage do not vote
+        taxlngs = [self.inferlineage(taxon) for taxon in table.taxa]
+        valid = np.array([len(l) > 0 for l in taxlngs], dtype=bool)[hits["taxon"]]
+        protein = hits["protein"][valid]
+        order = np.argsort(protein, kind="stable")
+        lngs = [taxlngs[t] for t in hits["taxon"][valid][order].tolist()]
+        w = weights[valid][order].tolist()
+        ends = np.cumsum(np.bincount(protein, minlength=nprot)).tolist()
+        starts = [0] + ends[:-1]
+        groups = [lngs[start:end] for start, end in zip(starts, ends)]
+        gweights = [w[start:end] for start, end in zip(starts, ends)] if self.weight else None
+        return consensus(groups, self.fraction, gweights), best
 
-    def vote_bin(self, proteinlngs):
-        lngs = [lng for prot, lng in proteinlngs.items()]
-        return majorityvote(lngs)
+    def vote(self, table, proteinlngs, best):
+        """
+        lineage of each bin of a hit table from the lineages of its proteins.
+        Returns the lineages and the number of proteins of each bin
+        """
+        protbin = np.frombuffer(table.proteinbin, dtype=np.int32)
+        order = np.argsort(protbin, kind="stable").tolist()
+        counts = np.bincount(protbin, minlength=len(table.bins)).tolist()
+        ends = np.cumsum(counts).tolist()
+        starts = [0] + ends[:-1]
+        lngs = [proteinlngs[i] for i in order]
+        groups = [lngs[start:end] for start, end in zip(starts, ends)]
+        gweights = None
+        if self.weight:
+            w = best[order].tolist()
+            gweights = [w[start:end] for start, end in zip(starts, ends)]
+        return consensus(groups, self.fraction, gweights), counts
 
 
 class multidiamond(diamond):
-    def __init__(self, proteinfiles, names, outdir, db, ncores=1, nsample=200):
+    """
+    infer the lineage of many bins with a single pooled diamond search.
+
+    In adaptive mode, proteins are searched in rounds of increasing size
+    (rounds gives the number of proteins per bin after each round). A bin
+    gets no new queries once its lineage is the same as in the previous
+    round and has at least depth levels with the given majority fraction.
+    """
+
+    def __init__(
+        self,
+        proteinfiles,
+        names,
+        outdir,
+        db,
+        ncores=1,
+        nsample=200,
+        adaptive=False,
+        rounds=(25, 50, 100, 200),
+        depth=6,
+        fraction=0.6,
+        weight=None,
+        shards=1,
+        blocksize=None,
+        indexchunks=None,
+        memory=None,
+    ):
         self.outdir = os.path.abspath(outdir)
         self.files = proteinfiles
         self.names = names
@@ -167,64 +361,152 @@ class multidiamond(diamond):
         self.log = os.path.join(self.outdir, "diamond.log")
         self.db = db
         self.ncores = ncores
+        self.fraction = fraction
+        self.weight = weight
+        self.set_resources(shards, blocksize, indexchunks, memory)
         self.lineages = {}
         if ncores == 1:
             logging.warning(
                 "You are running Diamond with a single core. This will be slow. We recommend using 8-16 cores."
             )
         # sample
-        with open(self.samplefile, "w") as f:
-            f.write("")
-        for fasta, name in zip(self.files, self.names):
-            self.sample(fasta, name, self.samplefile)
+        samples = self.sample_bins(nsample)
 
         # then run
-        self.search(self.outfile, self.samplefile)
+        if adaptive:
+            self.adaptive_search(samples, [r for r in rounds if r < nsample] + [nsample], depth)
+        else:
+            self.write_query(self.samplefile, samples)
+            self.search(self.outfile, self.samplefile)
         self.result = self.parse_results(self.outfile)
         self.lngs = self.vote_bins(self.result)
 
-    def sample(self, fasta, name, output, n=200):
+    def search(self, outfile, query):
+        """
+        search only proteins that are new to the hit cache, and each
+        distinct sequence only once. outfile holds the hits of all
+        queries as if all were searched
+        """
+        hits = get_hitcache()
+        search = get_resultcache().key("diamond", self.args, identities=[database_file(self.db)])
+        queries = []
+        for header, seq in read_fasta(query):
+            queries.append((record_name(header), sequence_hash(seq), seq))
+        found = hits.lookup(search, set([h for name, h, seq in queries]))
+        missing = {}
+        for name, h, seq in queries:
+            if h not in found and h not in missing:
+                missing[h] = seq
+        logging.debug(
+            "Diamond hit cache: %d queries, %d distinct, %d new"
+            % (len(queries), len(set([h for name, h, seq in queries])), len(missing))
+        )
+
+        if len(missing) > 0:
+            base = os.path.splitext(outfile)[0]
+            missquery = "{}.new.faa".format(base)
+            missresult = "{}.new.result".format(base)
+            with fastawriter(missquery) as fout:
+                for h, seq in missing.items():
+                    fout.write(h, seq)
+            if os.path.exists(missresult):
+                os.remove(missresult)
+            # hits of a failed search are not kept, so they are searched again next time
+            if super().search(missresult, missquery):
+                new = {h: [] for h in missing.keys()}
+                with open(missresult) as f:
+                    for line in f:
+                        h, _, rest = line.rstrip("\n").partition("\t")
+                        if h in new:
+                            new[h].append(rest)
+                new = {h: "\n".join(lines) for h, lines in new.items()}
+                hits.store(search, new)
+                found.update(new)
+
+        with open(outfile, "w") as fout:
+            for name, h, seq in queries:
+                if found.get(h):
+                    for rest in found[h].split("\n"):
+                        fout.write("{}\t{}\n".format(name, rest))
+
+    def sample(self, fasta, name, n=200):
         logging.debug("Sampeling %d proteins from %s" % (n, fasta))
-        try:
-            faa = Fasta(fasta)
-        except ZeroDivisionError:
-            logging.warning(
-                "Could not read the faa file as it probably \n contains no sequence information. \n Check file: %s "
-                % fasta
-            )
-            return 0
-        except Exception as e:
-            print(e)
-            return 0
-
-        keys = faa.keys()
-        if len(keys) > n:
-            keys = sample(keys, n)
-        with open(output, "a") as fout:
-            for k in keys:
-                fout.write(f">{name}_binseperator_{k}\n{str(faa[k])}\n")
+        return sample_proteins(fasta, n, bin_rng(name))
 
-    def parse_results(self, result):
-        def subdict():
-            return defaultdict(list)
-
-        r = defaultdict(subdict)
-        with open(result) as f:
-            for line in f:
-                l = line.strip().split("\t")
-                names = l[0].split("_binseperator_")
-                binname = names[0]
-                protein = names[1]
-                r[binname][protein].append(l[5])
-        return r
+    def sample_bins(self, n=200):
+        """sample the proteins of all bins at once, returns a dict of bin name to proteins"""
+        jobs = list(zip(self.files, self.names))
+        samples, failed = run_parallel(
+            lambda job: self.sample(job[0], job[1], n), jobs, self.ncores, label="protein sampling"
+        )
+        return {name: samples.get((fasta, name), []) for fasta, name in jobs}
+
+    def write_query(self, output, samples):
+        """pool the sampled proteins of all bins into one query file"""
+        with fastawriter(output) as fout:
+            for name, records in samples.items():
+                for k, seq in records:
+                    fout.write(f"{name}_binseperator_{k}", seq)
+
+    def adaptive_search(self, samples, rounds, depth):
+        """
+        search the sampled proteins in rounds, until the lineage of each
+        bin is stable. The queries and results of all rounds are pooled
+        into the usual samplefile.faa and diamond.result
+        """
+        # query the proteins of each bin in a random, but fixed order
+        for name, records in samples.items():
+            bin_rng(name).shuffle(records)
+        active = set([name for name, records in samples.items() if len(records) > 0])
+        previous = {}
+        done = 0
+        roundfiles = []
+        for i, target in enumerate(rounds):
+            if len(active) == 0:
+                break
+            query = {name: samples[name][done:target] for name in self.names if name in active}
+            logging.debug("Diamond round %d: %d bins with up to %d proteins" % (i + 1, len(active), target - done))
+            queryfile = os.path.join(self.outdir, "samplefile.round{}.faa".format(i + 1))
+            resultfile = os.path.join(self.outdir, "diamond.round{}.result".format(i + 1))
+            self.write_query(queryfile, query)
+            self.search(resultfile, queryfile)
+            roundfiles.append((queryfile, resultfile))
+            done = target
+
+            # vote with all results so far and stop bins that are stable
+            result = self.parse_results(*[r for q, r in roundfiles if os.path.exists(r)])
+            lngs = self.vote_bins(result)
+            for name in list(active):
+                lng = lngs.get(name, {"lng": []})["lng"]
+                stable = name in previous and len(lng) >= depth and previous[name][:depth] == lng[:depth]
+                if stable or len(samples[name]) <= done:
+                    active.discard(name)
+                previous[name] = lng
+        logging.debug("Diamond searched %d of %d sampled proteins" % (done, max(rounds)))
+
+        # pool all rounds, so the output looks like a single search
+        with open(self.samplefile, "wb") as qout, open(self.outfile, "wb") as rout:
+            for queryfile, resultfile in roundfiles:
+                with open(queryfile, "rb") as fin:
+                    shutil.copyfileobj(fin, qout)
+                if os.path.exists(resultfile):
+                    with open(resultfile, "rb") as fin:
+                        shutil.copyfileobj(fin, rout)
+
+    def parse_results(self, *results):
+        table = hittable(binsep="_binseperator_")
+        for result in results:
+            table.read(result)
+        return table
 
     def vote_bins(self, result):
-        binnames = result.keys()
+        with stage("lineage_vote"):
+            proteinlngs, best = self.lineage_infer_proteins(result)
+            binlngs, counts = self.vote(result, proteinlngs, best)
         lngs = {}
-        for bin in binnames:
-            protlng = self.lineage_infer_protein(result[bin])
+        for bin, lng, n in zip(result.bins, binlngs, counts):
             lngs[bin] = {}
-            lngs[bin]["lng"] = self.vote_bin(protlng)
-            lngs[bin]["n"] = len(protlng)
+            lngs[bin]["lng"] = lng
+            lngs[bin]["n"] = n
 
         return lngs
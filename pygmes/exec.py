@@ -1,23 +1,25 @@
 import logging
 import os
 import subprocess
+import threading
 import glob
-import re
-from pyfaidx import Fasta
-from pyfaidx import FastaIndexingError
+import itertools
 from random import sample, seed
 from collections import defaultdict
 from pygmes.diamond import diamond
 from pygmes.printlngs import print_lngs
-from ete3 import NCBITaxa
+from pygmes.parallel import run_command, RunCancelled, corescheduler, killed
+from pygmes.taxonomy import get_taxonomy
+from pygmes.models import get_modelindex, get_modelstore
+from pygmes.resultcache import get_resultcache
+from pygmes.translate import gtf_to_proteins, indexed_fasta
+from pygmes.gtf import genetable
+from pygmes.fasta import proteome_stats, read_fasta, fastawriter, record_name
+from pygmes.timings import stage, mark
 import shutil
-import gzip
-import urllib.request
 
 seed(4145421)
 
-url = "ftp://ftp.ebi.ac.uk/pub/databases/metagenomics/pygmes/latest/"
-
 
 def is_tool(name):
     """Check whether `name` is on PATH and marked as executable."""
@@ -38,7 +40,7 @@ def check_dependencies(software):
 def create_dir(d):
     if not os.path.isdir(d):
         try:
-            os.makedirs(d)
+            os.makedirs(d, exist_ok=True)
         except OSError as e:
             logging.warning(f"Could not create dir: {d}\n{e}")
 
@@ -53,14 +55,6 @@ def delete_folder(d):
                 print(e)
 
 
-def touch(fname, mode=0o666, dir_fd=None, **kwargs):
-    flags = os.O_CREAT | os.O_APPEND
-    with os.fdopen(os.open(fname, flags=flags, mode=mode, dir_fd=dir_fd)) as f:
-        os.utime(
-            f.fileno() if os.utime in os.supports_fd else fname, dir_fd=None if os.supports_fd else dir_fd, **kwargs
-        )
-
-
 class multistep_gmes:
     def __init__(self, fasta, outdir, ncores, diamonddb, models):
         self.outdir = outdir
@@ -119,8 +113,10 @@ class multistep_gmes:
 
 
 class gmes:
-    def __init__(self, fasta, outdir, ncores=1):
+    def __init__(self, fasta, outdir, ncores=1, name=None):
         self.fasta = os.path.abspath(fasta)
+        # label of the runs in the timings
+        self.name = name if name is not None else os.path.basename(fasta)
         self.outdir = os.path.abspath(outdir)
         self.logfile = os.path.join(self.outdir, "pygmes.log")
         self.loggtf = os.path.join(self.outdir, "pygmes_gtf.log")
@@ -135,21 +131,70 @@ class gmes:
         self.bedfile = False
         self.tax = []
         self.modelinfomap = {}
-        if ncores == 1:
-            logging.warning(
-                "You are running GeneMark-ES with a single core. This will be slow. We recommend using 4-8 cores."
-            )
+        # threading.Event to stop a running prediction early
+        self.cancel = None
+
+    def remove_outputs(self):
+        # outputs of an earlier run in this folder might be outdated,
+        # current ones are restored from the result cache
+        outputs = ["genemark.gtf", "prot_seq.faa", "prot_final.faa", "proteins.bed"]
+        for f in [os.path.join(self.outdir, f) for f in outputs]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def bedfile_path(self):
+        return os.path.join(self.outdir, "proteins.bed")
+
+    def state(self):
+        """the paths of a finished run, to continue with it in a later run (see from_state)"""
+        state = {"fasta": self.fasta, "outdir": self.outdir, "ncores": self.ncores, "name": self.name}
+        for key in ["gtf", "protfaa", "finalfaa", "bedfile", "model", "modelname"]:
+            state[key] = getattr(self, key, None)
+        return state
+
+    def outputs(self):
+        """the files of a successful run"""
+        if not self.check_success():
+            return []
+        return [f for f in [self.gtf, self.finalfaa, self.bedfile] if f]
+
+    @classmethod
+    def from_state(cls, state):
+        g = cls(state["fasta"], state["outdir"], state["ncores"], name=state.get("name"))
+        for key in ["gtf", "protfaa", "finalfaa", "bedfile", "model", "modelname"]:
+            if state[key] is not None:
+                setattr(g, key, state[key])
+        return g
+
+    def run_cached(self, lst, key, files, cancel=None):
+        """
+        run gmes_petap.pl, unless there is a cached result for key.
+        Returns True if GeneMark-ES succeeded
+        """
+        cache = get_resultcache()
+        status = cache.restore(key, self.outdir, files)
+        if status is not None:
+            logging.debug("Using cached GeneMark-ES result for %s" % self.fasta)
+            mark("cached" if status == "ok" else "failed")
+            return status == "ok"
+        try:
+            with open(self.logfile, "a") as fout:
+                run_command(lst, cwd=self.outdir, log=fout, cancel=cancel)
+        except subprocess.CalledProcessError as e:
+            self.check_for_license_issue(self.logfile)
+            # a run killed by a signal (such as the OOM killer) might succeed next time
+            if not killed(e.returncode):
+                cache.store(key, self.outdir, files, success=False)
+            mark("failed")
+            return False
+        success = all([os.path.exists(os.path.join(self.outdir, f)) for f in files])
+        cache.store(key, self.outdir, files, success=success)
+        if not success:
+            mark("failed")
+        return success
 
     def selftraining(self):
-        failpath = os.path.join(self.outdir, "tried_already")
-        if os.path.exists(failpath):
-            logging.info("Self-training skipped, as we did this before and it failed")
-            return
-        if os.path.exists(self.gtf):
-            logging.info("GTF file already exists, skipping")
-            self.gtf2faa()
-            return
-
+        self.remove_outputs()
         logging.debug("Starting self-training")
         lst = [
             "gmes_petap.pl",
@@ -163,12 +208,11 @@ class gmes:
             "--sequence",
             self.fasta,
         ]
-        try:
-            with open(self.logfile, "a") as fout:
-                subprocess.run(" ".join(lst), cwd=self.outdir, check=True, shell=True, stdout=fout, stderr=fout)
-        except subprocess.CalledProcessError:
-            self.check_for_license_issue(self.logfile)
-            touch(failpath)
+        cache = get_resultcache()
+        key = cache.key("gmes_petap.pl", ["--fungus", "--ES", "--min_contig", "5000"], [self.fasta])
+        with stage("gmes_training", bin=self.name, cores=self.ncores):
+            success = self.run_cached(lst, key, ["genemark.gtf", "output/gmhmm.mod"])
+        if not success:
             logging.info("GeneMark-ES in self-training mode has failed")
             return
         # predict and then clean
@@ -199,14 +243,7 @@ class gmes:
     def prediction(self, model):
         self.model = model
         self.modelname = os.path.basename(model).replace(".mod", "")
-        failpath = os.path.join(self.outdir, "tried_already")
-        if os.path.exists(failpath):
-            logging.info("Prediction skipped, as we did this before and it failed")
-            return
-        if os.path.exists(self.gtf):
-            logging.debug("GTF file already exists, skipping")
-            self.gtf2faa()
-            return
+        self.remove_outputs()
         logging.debug("Starting prediction")
         lst = [
             "gmes_petap.pl",
@@ -218,68 +255,69 @@ class gmes:
             "--sequence",
             self.fasta,
         ]
-        try:
-            with open(self.logfile, "a") as fout:
-                subprocess.run(" ".join(lst), cwd=self.outdir, check=True, shell=True, stdout=fout, stderr=fout)
-        except subprocess.CalledProcessError:
-            self.check_for_license_issue(self.logfile)
+        cache = get_resultcache()
+        key = cache.key("gmes_petap.pl", ["--predict_with"], [self.fasta, model])
+        with stage("gmes_prediction", bin=self.name, model=self.modelname, cores=self.ncores):
+            try:
+                success = self.run_cached(lst, key, ["genemark.gtf"], cancel=self.cancel)
+            except RunCancelled:
+                # remove the partial output, so a later run starts fresh
+                logging.debug("Prediction with %s was cancelled" % self.modelname)
+                mark("cancelled")
+                delete_folder(self.outdir)
+                return
+        if not success:
             logging.info("GeneMark-ES in prediction mode has failed")
-            touch(failpath)
+            self.clean_gmes_files()
+            return
         # predict and then clean
         self.gtf2faa()
         self.clean_gmes_files()
 
     def gtf2faa(self):
-        lst = ["get_sequence_from_GTF.pl", "genemark.gtf", self.fasta]
+        with stage("gtf2faa", bin=self.name, model=getattr(self, "modelname", None)):
+            self.translate_gtf()
+
+    def translate_gtf(self):
         if not os.path.exists(self.gtf):
             logging.debug("There is no GTF file")
             return
+        self.finalfaa = os.path.join(self.outdir, "prot_final.faa")
+        self.bedfile = self.bedfile_path()
+        if os.path.exists(self.finalfaa) and os.path.exists(self.bedfile):
+            logging.debug("Renamed faa exists, likely from previous run. Skipping this step")
+            if not os.path.exists(self.protfaa):
+                self.protfaa = self.finalfaa
+            return
+        try:
+            # translate the gtf and write the proteins renamed for CAT in one go,
+            # so prot_seq.faa is not needed anymore
+            gtf_to_proteins(self.gtf, self.fasta, self.finalfaa, self.bedfile)
+            self.protfaa = self.finalfaa
+            return
+        except Exception as e:
+            logging.warning("Could not translate the gtf, using get_sequence_from_GTF.pl instead: %s" % e)
+            for f in [self.finalfaa, self.bedfile]:
+                if os.path.exists(f):
+                    os.remove(f)
+
+        lst = ["get_sequence_from_GTF.pl", "genemark.gtf", self.fasta]
         if os.path.exists(self.protfaa):
             logging.debug("Protein file already exists, skipping")
         else:
             try:
                 with open(self.loggtf, "a") as fout:
-                    subprocess.run(" ".join(lst), cwd=self.outdir, check=True, shell=True, stdout=fout, stderr=fout)
+                    run_command(lst, cwd=self.outdir, log=fout)
             except subprocess.CalledProcessError:
                 logging.warning("could not get proteins from gtf")
+                mark("failed")
         # rename the proteins, to be compatibale with CAT
-        # self.gtf2bed(self.gtf, self.bedfile)
         self.rename_for_CAT()
 
     def parse_gtf(self, gtf):
         """Given a gtf file from genemark es it extracts
         some information to create a bed file"""
-        nre = re.compile(r'gene_id "([0-9]+_g)\";')
-
-        def beddict():
-            return {"chrom": None, "r": [], "strand": None}
-
-        beds = defaultdict(beddict)
-        with open(gtf) as f:
-            for line in f:
-                # skip comment lines
-                if line.startswith("#"):
-                    continue
-
-                l = line.split("\t")
-                # chrom = l[0].strip()
-                # start = int(l[3])
-                # stop = int(l[4])
-                # strand = l[6]
-
-                # regex match
-                m = nre.findall(l[8])
-                if m is not None:
-                    name = m[0]
-                else:
-                    continue
-
-                # save all in the dictonary
-                beds[name]["chrom"] = l[0]
-                beds[name]["r"].append(int(l[3]))
-                beds[name]["r"].append(int(l[4]))
-                beds[name]["strand"] = l[6]
-        return beds
+        return genetable.from_gtf(gtf)
 
     def gtf2bed(self, gtf, outfile, rename=None, beds=None):
         """
@@ -295,18 +333,19 @@ class gmes:
         if beds is None:
             beds = self.parse_gtf(gtf)
         # check that keys() are contained
-        for name, v in beds.items():
-            if rename is not None:
+        if rename is not None:
+            for name in beds.genes:
                 if name not in rename.keys():
                     logging.warning("Error creating bed file")
                     exit(1)
 
         # write to file
         with open(outfile, "w") as f:
-            for name, v in beds.items():
+            for name in beds.genes:
+                chrom, start, stop, strand = beds.row(name)
                 if rename is not None:
                     name = rename[name]
-                vals = "\t".join([v["chrom"], str(min(v["r"])), str(max(v["r"])), v["strand"], name])
+                vals = "\t".join([chrom, str(start), str(stop), strand, name])
                 f.write("{}\n".format(vals))
 
     def rename_for_CAT(self, faa=None, gtf=None):
@@ -319,7 +358,7 @@ class gmes:
                 >NODE_1_1
         """
         self.finalfaa = os.path.join(self.outdir, "prot_final.faa")
-        self.bedfile = os.path.join(self.outdir, "proteins.bed")
+        self.bedfile = self.bedfile_path()
         if os.path.exists(self.finalfaa) and os.path.exists(self.bedfile):
             logging.debug("Renamed faa exists, likely from previous run. Skipping this step")
             return
@@ -327,15 +366,8 @@ class gmes:
             faa = self.protfaa
         if gtf is None:
             gtf = self.gtf
-        try:
-            faa = Fasta(faa)
-        except FastaIndexingError:
-            logging.warning("Fastaindexing error")
-            self.finalfaa = False
-            return
-        except Exception as e:
-            logging.warning("Unhandled pyfaidx Fasta error")
-            print(e)
+        if not os.path.exists(faa) or proteome_stats(faa)["proteins"] == 0:
+            logging.warning("Protein fasta is missing or empty: %s" % faa)
             self.finalfaa = False
             return
         # load gtf
@@ -345,24 +377,31 @@ class gmes:
         renamed = {}
         logging.debug("Creating metadata for %s" % self.finalfaa)
         # parse and rename
-        with open(self.finalfaa, "w") as fout:
-            for record in faa:
-                if record.name not in beds.keys():
+        with fastawriter(self.finalfaa) as fout:
+            for header, seq in read_fasta(faa):
+                name = record_name(header)
+                if name not in beds:
                     logging.warning("The protein was not found in the gtf file:")
-                    print("protein: %s" % record.name)
+                    print("protein: %s" % name)
                     print("GTF file: %s" % gtf)
                     logging.warning("stopping here, this is a bug in pygmes or an issue with GeneMark-ES")
                     exit(1)
-                contig = beds[record.name]["chrom"]
+                contig = beds.row(name)[0]
                 orfcounter[contig] += 1
                 # we use 1 as the first number, instead of the cool 0
                 newprotname = "{}_{}".format(contig, orfcounter[contig])
                 # keep track of the renaming, so we can rename the bed
-                renamed[record.name] = newprotname
-                fout.write(">{}\n{}\n".format(newprotname, record))
+                renamed[name] = newprotname
+                fout.write(newprotname, seq)
         # write renamed bed
         self.gtf2bed(self.gtf, self.bedfile, renamed, beds)
 
+    def aminoacids(self):
+        """number of amino acids in the predicted proteins"""
+        if self.finalfaa is False or not os.path.exists(self.protfaa):
+            return 0
+        return proteome_stats(self.protfaa)["residues"]
+
     def check_success(self):
         if self.finalfaa is False:
             return False
@@ -372,19 +411,10 @@ class gmes:
             return False
 
         # now more in detail
-        # check if proteins are empty maybe
-        with open(self.finalfaa) as fa:
-            next(fa)
-            for line in fa:
-                if line.strip() == "":
-                    return False
-                break
-        # if we can not open it, its of no use
-        try:
-            Fasta(self.finalfaa)
-        except Exception:
+        # check if there are proteins and none of them is empty
+        stats = proteome_stats(self.finalfaa)
+        if stats["proteins"] == 0 or stats["empty"] > 0:
             return False
-
         return True
 
     def estimate_tax(self, db):
@@ -393,54 +423,135 @@ class gmes:
         d = diamond(self.protfaa, ddir, db, sample=200, ncores=self.ncores)
         self.tax = d.lineage
 
-    def premodel(self, models, stage=1, existing_prediction=None):
+    def predict_models(self, modelfiles, fasta, outdir, first_wins=False):
+        """
+        predict proteins in fasta with each model, sharing self.ncores
+        between all predictions. Returns the successful runs in the order
+        of modelfiles.
+        If first_wins is set, only the successful run with the first model
+        in modelfiles is returned. Once a run succeeded, the runs with models
+        after it are cancelled, while those before it keep running, so the
+        result does not depend on which run finishes first.
+        """
+        cancel = {model: threading.Event() for model in modelfiles}
+
+        def predict(model, cores):
+            if cancel[model].is_set():
+                return None
+            logging.debug("Using model %s" % os.path.basename(model))
+            name = os.path.basename(model)
+            odir = os.path.join(outdir, name)
+            g = gmes(fasta, odir, ncores=cores, name=self.name)
+            if first_wins:
+                g.cancel = cancel[model]
+            g.prediction(model)
+            if g.check_success():
+                if first_wins:
+                    logging.debug("Stopping the predictions with models after %s" % name)
+                    rank = modelfiles.index(model)
+                    for i, later in enumerate(modelfiles):
+                        if i > rank:
+                            cancel[later].set()
+                return g
+            return None
+
+        # index the genome once, before the predictions translate their genes at the same time
+        indexed_fasta(fasta).close()
+        # share the cores between all candidate models
+        cores = max(1, self.ncores // max(1, len(modelfiles)))
+        scheduler = corescheduler(self.ncores)
+        for model in modelfiles:
+            scheduler.add(model, lambda c, model=model: predict(model, c), cores=cores)
+        predictions, failed = scheduler.run()
+        runs = [predictions[model] for model in modelfiles if predictions.get(model) is not None]
+        return runs[:1] if first_wins else runs
+
+    def subsample_contigs(self, output, fraction=0.2, min_bp=2000000):
+        """
+        write a representative subset of the contigs to output.
+        Contigs are sorted by length and every n-th contig is kept, so
+        the subsample covers the whole length distribution. Returns the
+        number of bases in the subsample and in the whole genome.
+        """
+        with indexed_fasta(self.fasta) as fa:
+            contigs = sorted([(len(seq), seq.name) for seq in fa], reverse=True)
+            total = sum([c[0] for c in contigs])
+            step = max(1, int(round(1 / fraction)))
+            selected = set(range(0, len(contigs), step))
+            size = sum([contigs[i][0] for i in selected])
+            # fill up with the longest remaining contigs
+            for i in range(len(contigs)):
+                if size >= min_bp:
+                    break
+                if i not in selected:
+                    selected.add(i)
+                    size += contigs[i][0]
+            with open(output, "w") as fout:
+                for i in sorted(selected):
+                    name = contigs[i][1]
+                    fout.write(f">{name}\n{fa[name]}\n")
+        return size, total
+
+    def screen_models(self, modelfiles, keep=3, fraction=0.2, min_bp=2000000):
+        """
+        rank models by the amino acids they predict on a subsample of
+        the contigs and only return the best keep models.
+        If the subsample would not be much smaller than the genome, all
+        models are returned.
+        """
+        screendir = os.path.join(self.outdir, "screening")
+        create_dir(screendir)
+        subsample = os.path.join(screendir, "subsample.fna")
+        size, total = self.subsample_contigs(subsample, fraction, min_bp)
+        if size > total * 0.5:
+            logging.debug("Genome is too small to screen models on a subsample")
+            return modelfiles
+        logging.debug("Screening {} models on {} of {} bp".format(len(modelfiles), size, total))
+        runs = self.predict_models(modelfiles, subsample, screendir)
+        if len(runs) == 0:
+            logging.debug("No model predicted proteins on the subsample, keeping all")
+            return modelfiles
+        # stable sort, so ties keep the order of modelfiles
+        runs.sort(key=lambda g: g.aminoacids(), reverse=True)
+        return [g.model for g in runs[:keep]]
+
+    def premodel(self, models, stage=1, existing_prediction=None, screen=None):
+        """
+        predict proteins with all models in the folder models and
+        return the prediction with the most amino acids.
+
+        In stage 1 the successful prediction with the first model (by
+        file name) is used instead.
+        If screen is set and there are more candidates than that, only
+        the best screen models on a contig subsample are predicted on
+        the whole genome.
+        """
         logging.debug("On bin: %s" % self.fasta)
-        logging.debug("Running the pre Model stage %d" % stage)
+        logging.debug("Running the pre Model stage %s" % stage)
         logging.debug("Using model directory: %s", models)
         self.bestpremodel = False
-        modelfiles = glob.glob(os.path.join(models, "*.mod"))
+        # sorted, so stage 1 picks the same model in every run
+        modelfiles = sorted(glob.glob(os.path.join(models, "*.mod")))
         # incoporate existing prediction if possible
         if existing_prediction is None:
             subgmes = []
         else:
             subgmes = [existing_prediction]
+        if screen is not None and stage != 1 and len(modelfiles) > screen:
+            modelfiles = self.screen_models(modelfiles, keep=screen)
         logging.debug("Predicting proteins using {} models".format(len(modelfiles)))
-        for model in modelfiles:
-            logging.debug("Using model %s" % os.path.basename(model))
-            name = os.path.basename(model)
-            odir = os.path.join(self.outdir, "{}_premodels".format(stage), name)
-            g = gmes(self.fasta, odir, ncores=self.ncores)
-            g.prediction(model)
-            if g.check_success():
-                subgmes.append(g)
-                if stage == 1:
-                    logging.debug("Stopping stage 1 prediction, as we have one proteome to predict the lineage")
-                    break
+        odir = os.path.join(self.outdir, "{}_premodels".format(stage))
+        subgmes.extend(self.predict_models(modelfiles, self.fasta, odir, first_wins=(stage == 1)))
 
         if len(subgmes) == 0:
             logging.warning("Could not predict any proteins in this file")
             return False
         else:
-            aminoacidcount = []
-            for g in subgmes:
-                i = 0
-                try:
-                    fa = Fasta(g.protfaa)
-                    for seq in fa:
-                        i += len(seq)
-                except FastaIndexingError:
-                    logging.warning("Could not read fasta")
-                except Exception as e:
-                    logging.debug("Unhandled pyfaidx Fasta error")
-                    print(e)
-
-                aminoacidcount.append(i)
-            if len(aminoacidcount) == 0:
-                logging.error("Could not determine best model")
-                return False
+            aminoacidcount = [g.aminoacids() for g in subgmes]
             # set the best model as the model leading to the most amino acids
             idx = aminoacidcount.index(max(aminoacidcount))
             logging.info("Best model set as: %s" % os.path.basename(subgmes[idx].model))
+            self.bestpremodel = subgmes[idx]
             return subgmes[idx]
 
     def fetchinfomap(self):
@@ -448,17 +559,14 @@ class gmes:
         function to make sure the information of all models
         is known to the class
         """
-        ncbi = NCBITaxa()
         if len(self.modelinfomap) == 0:
-            info = self.fetch_info("{}info.csv".format(url))
-            logging.debug("Fetching models from {}".format(url))
-            for line in info.split("\n"):
-                l = line.split(",")
-                # fetch lineage from ete3 for each model
-                # time consuming but important to adapt to changes
-                # in NCBI taxonomy
-                if len(l) > 1:
-                    self.modelinfomap[l[0]] = ncbi.get_lineage(l[1])
+            store = get_modelstore()
+            logging.debug("Fetching models from {}".format(store.remote))
+            info = store.fetch_info()
+            # the lineages of all models are only looked up once
+            # and are updated if the NCBI taxonomy changes
+            self.modelindex = get_modelindex(info)
+            self.modelinfomap = self.modelindex.lineages
 
     def infer_model(self, tax, n=3):
         """
@@ -472,72 +580,48 @@ class gmes:
         self.fetchinfomap()
         logging.debug("Inferring model")
 
-        candidates = self.score_models(self.modelinfomap, tax, at_least=n)
+        candidates = self.score_models(self.modelindex, tax, at_least=n)
 
         if len(candidates) > n:
             candidates = sample(candidates, n)
             logging.debug("Reduced models to {}".format(n))
-        # for each candidate, try to download the model into a file
+        # link the candidates from the model store, fetching missing ones
         modeldir = os.path.join(self.outdir, "models")
         delete_folder(modeldir)
         create_dir(modeldir)
-        for model in candidates:
-            self.fetch_model(modeldir, url, model)
+        get_modelstore().link(candidates, modeldir)
 
         return modeldir
 
-    def fetch_model(self, folder, url, name):
-        url = "{}/models/{}.mod.gz".format(url, name)
-        modelfile = os.path.join(folder, "{}.mod".format(name))
-        response = urllib.request.urlopen(url)
-        data = response.read()  # a `bytes` object
-        content = gzip.decompress(data)
-        with open(modelfile, "w") as mod:
-            mod.writelines(content.decode())
-
-    def fetch_info(self, url, i=5):
-        logging.debug("opening url {}".format(url))
-        try:
-            response = urllib.request.urlopen(url)
-            data = response.read()  # a `bytes` object
-            infocsv = data.decode("utf-8")
-        except urllib.error.URLError:
-            import time
-
-            if i > 0:
-                i = i - 1
-                time.sleep(5)
-                infocsv = self.fetch_info(url, i)
-            else:
-                logging.error("Could not fetch model file")
-                exit(1)
-
-        return infocsv
-
-    def score_models(self, infomap, lng, at_least=3):
+    def score_models(self, index, lng, at_least=3):
         logging.debug("scoring all models")
-        scores = []
         candidates = []
 
-        for model, mlng in infomap.items():
-            score = len(set(lng) & set(mlng))
-            scores.append((model, score))
-        # sort scored models
-        scores.sort(key=lambda x: x[1], reverse=True)
-        if len(scores) == 0:
+        if len(index.models) == 0:
             logging.error("No models were obtained, so none were scored")
             exit(1)
+        # only models sharing a taxid with lng are scored,
+        # all other models have a score of 0
+        scores = index.score(lng)
+        scored = set([x[0] for x in scores])
+        scores.sort(key=lambda x: x[1], reverse=True)
+        unscored = ((model, 0) for model in index.models if model not in scored)
+        scores = itertools.chain(scores, unscored)
 
-        maxscore = scores[0][1]
+        maxscore = None
         # get all models with the highest score,
         # and then fill up till at_least
         for x in scores:
+            if maxscore is None:
+                maxscore = x[1]
             if x[1] == maxscore:
                 candidates.append(x[0])
                 logging.debug("Choose model {} with score {}".format(x[0], x[1]))
             elif len(candidates) < at_least and x[1] != maxscore:
                 candidates.append(x[0])
                 logging.debug("Choose model {} with score {}".format(x[0], x[1]))
+            else:
+                break
         return candidates
 
     def writetax(self):
@@ -545,7 +629,7 @@ class gmes:
         write infered taxonomy in a machine and human readble format
         """
         logging.info("Translating lineage")
-        ncbi = NCBITaxa()
+        ncbi = get_taxonomy()
         taxf = os.path.join(self.outdir, "lineage.txt")
         with open(taxf, "w") as fout:
             # get the information
@@ -0,0 +1,298 @@
+import gzip
+import json
+import logging
+import mmap
+import os
+import shutil
+import subprocess
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def _record(raw):
+    """split a raw record (without the leading >) into header and sequence"""
+    header, _, seq = raw.partition(b"\n")
+    return header.rstrip(b"\r"), seq.replace(b"\n", b"").replace(b"\r", b"")
+
+
+def read_fasta(path, use_mmap=False, blocksize=1 << 22):
+    """
+    yields (header, sequence) of each record as bytes, without building
+    an index. The header is the full line without the leading >.
+
+    The file is read in large blocks, or memory mapped if use_mmap is set,
+    and each record is cut out at once instead of line by line.
+    """
+    with open(path, "rb") as fin:
+        if use_mmap:
+            if os.fstat(fin.fileno()).st_size == 0:
+                return
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = mm.find(b">")
+                while start != -1:
+                    first = start + 1
+                    end = mm.find(b"\n>", start)
+                    if end == -1:
+                        yield _record(mm[first:])
+                        break
+                    yield _record(mm[first:end])
+                    start = end + 1
+            return
+
+        buffer = bytearray()
+        started = False
+        while True:
+            block = fin.read(blocksize)
+            if not block:
+                break
+            buffer += block
+            if not started:
+                start = buffer.find(b">")
+                if start == -1:
+                    buffer.clear()
+                    continue
+                del buffer[:start]
+                started = True
+            # only the last record in the buffer can be incomplete
+            last = buffer.rfind(b"\n>")
+            if last == -1:
+                continue
+            complete = bytes(buffer[1:last])
+            del buffer[: last + 1]
+            for raw in complete.split(b"\n>"):
+                yield _record(raw)
+        if started and len(buffer) > 0:
+            for raw in bytes(buffer[1:]).split(b"\n>"):
+                yield _record(raw)
+
+
+def record_name(header):
+    """name of a record as used by pyfaidx, the first word of the header"""
+    return header.split(None, 1)[0].decode() if header.strip() else ""
+
+
+class fastawriter:
+    """write fasta records, collecting them into large batches before writing"""
+
+    def __init__(self, path, mode="w", batchsize=1 << 20):
+        self.fout = open(path, mode.replace("b", "") + "b")
+        self.batchsize = batchsize
+        self.batch = []
+        self.size = 0
+
+    def write(self, header, seq):
+        if isinstance(header, str):
+            header = header.encode()
+        if isinstance(seq, str):
+            seq = seq.encode()
+        self.batch.append(b">%s\n%s\n" % (header, seq))
+        self.size += len(header) + len(seq) + 3
+        if self.size >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        self.fout.write(b"".join(self.batch))
+        self.batch = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def open_fasta(path, blocksize=1 << 22):
+    """
+    binary stream of a fasta file. Gzipped files are decompressed by pigz
+    in a separate process if it is installed, otherwise with zlib.
+    """
+    if not path.endswith(".gz"):
+        with open(path, "rb", buffering=blocksize) as fin:
+            yield fin
+        return
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        with gzip.open(path, "rb") as fin:
+            yield fin
+        return
+    p = subprocess.Popen([pigz, "-dc", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=blocksize)
+    try:
+        yield p.stdout
+        # read the rest, so pigz can finish
+        while p.stdout.read(blocksize):
+            pass
+    finally:
+        p.stdout.close()
+        err = p.stderr.read()
+        p.stderr.close()
+        if p.wait() != 0 and err:
+            logging.warning("pigz: %s" % err.decode(errors="replace").strip())
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, [pigz, "-dc", path])
+
+
+def uncompressed_size(path):
+    """
+    size of a fasta file in bytes, for gzipped files the size once decompressed.
+    That is read from the gzip trailer, which holds it modulo 4 GB
+    """
+    size = os.path.getsize(path)
+    if not path.endswith(".gz") or size < 18:
+        return size
+    with open(path, "rb") as fin:
+        fin.seek(-4, os.SEEK_END)
+        isize = int.from_bytes(fin.read(4), "little")
+    # add the 4 GB wraps, assuming at least the compressed size
+    while isize < size:
+        isize += 1 << 32
+    return isize
+
+
+def rewrite_headers(fin, fout, mapping, blocksize=1 << 22):
+    """
+    copy a fasta from fin to fout (binary streams), giving each record a
+    unique name: the first word of its header, with .1, .2 and so on
+    added to repeated names. Each header is written to mapping as a line
+    old,new. Only the headers are touched, the sequence between them is
+    copied in large blocks. Line endings are converted to \\n.
+    Returns the number of records.
+    """
+    seen = defaultdict(int)
+
+    def rename(line):
+        line = line.strip()
+        first = line.split()[0]
+        name = first if seen[first] == 0 else b"%s.%d" % (first, seen[first])
+        seen[first] += 1
+        fout.write(name + b"\n")
+        mapping.write((b"%s,%s\n" % (line, name)).replace(b">", b""))
+
+    data = b""
+    # if the last block ended inside of a line, a > at the start of the next one is no header
+    linestart = True
+    while True:
+        block = fin.read(blocksize)
+        if not block:
+            break
+        if block.endswith(b"\r"):
+            # keep \r\n together
+            block += fin.read(1)
+        if b"\r" in block:
+            block = block.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        data += block
+        start = 0
+        while start < len(data):
+            if linestart and data.startswith(b">", start):
+                end = data.find(b"\n", start)
+                if end == -1:
+                    # the header continues in the next block
+                    break
+                rename(data[start:end])
+                start = end + 1
+                continue
+            # sequence up to the next header, or all of it
+            end = data.find(b"\n>", start)
+            if end == -1:
+                fout.write(data[start:])
+                linestart = data.endswith(b"\n")
+                start = len(data)
+                break
+            stop = end + 1
+            fout.write(data[start:stop])
+            start = stop
+            linestart = True
+        data = data[start:]
+    # a header in the last line, without line break
+    if data:
+        rename(data)
+    return sum(seen.values())
+
+
+def read_fai(fai):
+    """lengths of all sequences in a samtools/pyfaidx index"""
+    lengths = []
+    with open(fai) as fin:
+        for line in fin:
+            l = line.split("\t")
+            if len(l) >= 2:
+                lengths.append(int(l[1]))
+    return lengths
+
+
+def scan_lengths(fasta):
+    """lengths of all sequences of a fasta file, in one pass over the raw bytes"""
+    lengths = []
+    n = None
+    with open(fasta, "rb", buffering=1 << 20) as fin:
+        for line in fin:
+            if line.startswith(b">"):
+                if n is not None:
+                    lengths.append(n)
+                n = 0
+            elif n is not None:
+                n += len(line.rstrip())
+    if n is not None:
+        lengths.append(n)
+    return lengths
+
+
+def summarize(lengths):
+    stats = {"proteins": len(lengths), "residues": sum(lengths), "empty": lengths.count(0)}
+    if len(lengths) == 0:
+        stats.update({"min": 0, "max": 0, "mean": 0, "n50": 0})
+        return stats
+    ordered = sorted(lengths, reverse=True)
+    half = stats["residues"] / 2
+    acc = 0
+    n50 = 0
+    for length in ordered:
+        acc += length
+        if acc >= half:
+            n50 = length
+            break
+    stats.update({"min": ordered[-1], "max": ordered[0], "mean": stats["residues"] / len(lengths), "n50": n50})
+    return stats
+
+
+def proteome_stats(faa, cache=True):
+    """
+    number of proteins, number of residues and the length distribution
+    of a protein fasta.
+
+    The lengths are taken from an existing .fai index, or from a single
+    scan of the file. Unless cache is False, the result is saved next to
+    the file as <faa>.stats.json and reused as long as the file does not change.
+    """
+    st = os.stat(faa)
+    cachefile = "{}.stats.json".format(faa)
+    try:
+        with open(cachefile) as fin:
+            cached = json.load(fin)
+        if cached["size"] == st.st_size and cached["mtime"] == st.st_mtime_ns:
+            return cached["stats"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    fai = "{}.fai".format(faa)
+    if os.path.exists(fai) and os.path.getmtime(fai) >= st.st_mtime:
+        lengths = read_fai(fai)
+    else:
+        lengths = scan_lengths(faa)
+    stats = summarize(lengths)
+    if not cache:
+        return stats
+    try:
+        tmp = "{}.{}.{}.tmp".format(cachefile, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as fout:
+            json.dump({"size": st.st_size, "mtime": st.st_mtime_ns, "stats": stats}, fout)
+        os.replace(tmp, cachefile)
+    except OSError:
+        logging.debug("Could not save protein statistics for %s" % faa)
+    return stats
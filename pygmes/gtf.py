@@ -0,0 +1,104 @@
+from array import array
+
+
+def gene_id(attributes):
+    """extract the gene_id from the attribute column of a GeneMark-ES gtf"""
+    start = attributes.find('gene_id "')
+    if start == -1:
+        return None
+    start += 9
+    end = attributes.find('"', start)
+    if end == -1:
+        return None
+    return attributes[start:end]
+
+
+def iter_features(gtf):
+    """
+    yields (gene, chrom, feature, start, stop, strand, frame) for every
+    line of a GeneMark-ES gtf, with 1-based coordinates
+    """
+    with open(gtf) as fin:
+        for line in fin:
+            if line.startswith("#"):
+                continue
+            l = line.split("\t", 8)
+            if len(l) < 9:
+                continue
+            name = gene_id(l[8])
+            if name is None:
+                continue
+            yield (name, l[0], l[2], int(l[3]), int(l[4]), l[6], l[7])
+
+
+def iter_genes(gtf):
+    """
+    yields (gene, chrom, start, stop, strand) for every gene in one pass
+    over the gtf. Only the range of all features of a gene is kept.
+    GeneMark-ES writes all lines of a gene together, so a gene is yielded
+    as soon as the next starts.
+    """
+    current = None
+    for name, chrom, feature, start, stop, strand, frame in iter_features(gtf):
+        if current is None or current[0] != name:
+            if current is not None:
+                yield tuple(current)
+            current = [name, chrom, start, stop, strand]
+        if start < current[2]:
+            current[2] = start
+        if stop > current[3]:
+            current[3] = stop
+    if current is not None:
+        yield tuple(current)
+
+
+class genetable:
+    """
+    compact, array backed table of the genes in a gtf file.
+    Contigs are stored once and referenced by their code.
+    """
+
+    def __init__(self):
+        self.genes = []
+        self.chroms = []
+        self.chrom = array("i")
+        self.start = array("q")
+        self.stop = array("q")
+        self.strand = bytearray()
+        self.rows = {}
+        self._chromcodes = {}
+
+    @classmethod
+    def from_gtf(cls, gtf):
+        table = cls()
+        for gene in iter_genes(gtf):
+            table.add(*gene)
+        return table
+
+    def add(self, name, chrom, start, stop, strand):
+        if name in self.rows:
+            # a gene that was split in the gtf, merge it
+            i = self.rows[name]
+            self.start[i] = min(self.start[i], start)
+            self.stop[i] = max(self.stop[i], stop)
+            return
+        if chrom not in self._chromcodes:
+            self._chromcodes[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+        self.rows[name] = len(self.genes)
+        self.genes.append(name)
+        self.chrom.append(self._chromcodes[chrom])
+        self.start.append(start)
+        self.stop.append(stop)
+        self.strand += strand.encode()
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def row(self, name):
+        """returns (chrom, start, stop, strand) of a gene"""
+        i = self.rows[name]
+        return (self.chroms[self.chrom[i]], self.start[i], self.stop[i], chr(self.strand[i]))
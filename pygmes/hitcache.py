@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from pygmes.config import cache_dir
+from pygmes.resultcache import get_resultcache
+
+
+def sequence_hash(seq):
+    """hash of a protein sequence, independent of case and a trailing stop"""
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return hashlib.sha256(seq.upper().rstrip(b"*")).hexdigest()
+
+
+class hitcache:
+    """
+    diamond hits of single proteins, shared between runs.
+
+    Hits are stored per protein sequence hash and search key, where the
+    search key covers the diamond version, its arguments and the
+    database. Each entry holds the hit lines without the query name,
+    an empty entry means the protein was searched but had no hits.
+    """
+
+    def __init__(self, path=None, enabled=True):
+        if path is None:
+            path = cache_dir("hits.sqlite")
+        self.path = path
+        self.enabled = enabled
+        self.ready = False
+
+    def connect(self):
+        if not self.ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=120)
+        if not self.ready:
+            con.execute("CREATE TABLE IF NOT EXISTS hits (seq TEXT, search TEXT, hits TEXT, PRIMARY KEY (seq, search))")
+            con.commit()
+            self.ready = True
+        return con
+
+    def lookup(self, search, hashes, chunksize=500):
+        """returns the cached hits of all known sequence hashes"""
+        found = {}
+        if not self.enabled or len(hashes) == 0:
+            return found
+        hashes = list(hashes)
+        try:
+            con = self.connect()
+            try:
+                for start in range(0, len(hashes), chunksize):
+                    end = start + chunksize
+                    chunk = hashes[start:end]
+                    query = "SELECT seq, hits FROM hits WHERE search = ? AND seq IN ({})".format(
+                        ",".join(["?"] * len(chunk))
+                    )
+                    for seq, hits in con.execute(query, [search] + chunk):
+                        found[seq] = hits
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            logging.warning("Could not read the diamond hit cache: %s" % e)
+        return found
+
+    def store(self, search, hits):
+        """hits is a dict of sequence hash to the hit lines of that sequence"""
+        if not self.enabled or len(hits) == 0:
+            return
+        try:
+            con = self.connect()
+            try:
+                with con:
+                    con.executemany(
+                        "INSERT OR REPLACE INTO hits (seq, search, hits) VALUES (?, ?, ?)",
+                        [(seq, search, h) for seq, h in hits.items()],
+                    )
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            logging.warning("Could not update the diamond hit cache: %s" % e)
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def set_hitcache(path=None, enabled=True):
+    global _cache
+    with _lock:
+        _cache = hitcache(path, enabled)
+    return _cache
+
+
+def get_hitcache():
+    """returns the diamond hit cache, disabled together with the result cache"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = hitcache(enabled=get_resultcache().enabled)
+    return _cache
@@ -0,0 +1,123 @@
+from array import array
+import numpy as np
+
+
+class hittable:
+    """
+    diamond hits (outfmt 6 qseqid sseqid pident evalue bitscore staxids)
+    in compact typed columns.
+
+    Each hit is stored as bin, protein, pident, evalue, bitscore and
+    taxon, where bins, proteins and taxa are indices into tables holding
+    each distinct name once. A taxon is the raw staxids value, which
+    can list several taxids (123;456).
+
+    If binsep is given, the query names are split into the bin and
+    the protein name at the first binsep.
+    """
+
+    def __init__(self, binsep=None):
+        self.binsep = binsep.encode() if binsep is not None else None
+        self.bins = []
+        self.proteins = []
+        self.proteinbin = array("i")
+        self.taxa = []
+        self._bins = {}
+        self._proteins = {}
+        self._taxa = {}
+        self.bin = array("i")
+        self.protein = array("i")
+        self.pident = array("f")
+        self.evalue = array("d")
+        self.bitscore = array("f")
+        self.taxon = array("i")
+
+    def __len__(self):
+        return len(self.protein)
+
+    def intern_protein(self, qseqid):
+        if self.binsep is not None:
+            binname, _, name = qseqid.partition(self.binsep)
+        else:
+            binname, name = b"", qseqid
+        binname = binname.decode()
+        if binname not in self._bins:
+            self._bins[binname] = len(self.bins)
+            self.bins.append(binname)
+        i = len(self.proteins)
+        self._proteins[qseqid] = i
+        self.proteins.append(name.decode())
+        self.proteinbin.append(self._bins[binname])
+        return i
+
+    def intern_taxon(self, staxids):
+        i = len(self.taxa)
+        self._taxa[staxids] = i
+        self.taxa.append(staxids.decode())
+        return i
+
+    def read(self, path, blocksize=1 << 22):
+        """
+        add the hits of a diamond output. The file is read in large
+        blocks and each block is split into columns at once
+        """
+        rest = b""
+        with open(path, "rb") as fin:
+            while True:
+                block = fin.read(blocksize)
+                if not block:
+                    self.add_block(rest)
+                    break
+                block = rest + block
+                end = block.rfind(b"\n")
+                if end == -1:
+                    rest = block
+                    continue
+                start = end + 1
+                rest = block[start:]
+                self.add_block(block[:end])
+        return self
+
+    def add_block(self, block):
+        """add complete lines of diamond output"""
+        block = block.replace(b"\r", b"").strip(b"\n")
+        if len(block) == 0:
+            return
+        # split all lines at once, without a list per line
+        nlines = block.count(b"\n") + 1
+        fields = block.replace(b"\n", b"\t").split(b"\t")
+        if len(fields) != 6 * nlines:
+            # blank lines, or lines without or with extra columns.
+            # A missing staxids column is read as an unknown taxon
+            rows = [line.split(b"\t") for line in block.split(b"\n")]
+            rows = [l[:6] if len(l) > 5 else l + [b""] for l in rows if len(l) >= 5]
+            fields = [f for l in rows for f in l]
+            nlines = len(rows)
+            if nlines == 0:
+                return
+        qseqid = fields[0::6]
+        staxids = fields[5::6]
+        for q in dict.fromkeys(qseqid):
+            if q not in self._proteins:
+                self.intern_protein(q)
+        for t in dict.fromkeys(staxids):
+            if t not in self._taxa:
+                self.intern_taxon(t)
+        protein = np.fromiter(map(self._proteins.__getitem__, qseqid), dtype=np.int32, count=nlines)
+        self.protein.frombytes(protein.tobytes())
+        self.bin.frombytes(np.frombuffer(self.proteinbin, dtype=np.int32)[protein].tobytes())
+        self.pident.frombytes(np.array(fields[2::6]).astype(np.float32).tobytes())
+        self.evalue.frombytes(np.array(fields[3::6]).astype(np.float64).tobytes())
+        self.bitscore.frombytes(np.array(fields[4::6]).astype(np.float32).tobytes())
+        self.taxon.frombytes(np.fromiter(map(self._taxa.__getitem__, staxids), dtype=np.int32, count=nlines).tobytes())
+
+    def columns(self):
+        """the columns as numpy arrays, without copying them"""
+        return {
+            "bin": np.frombuffer(self.bin, dtype=np.int32),
+            "protein": np.frombuffer(self.protein, dtype=np.int32),
+            "pident": np.frombuffer(self.pident, dtype=np.float32),
+            "evalue": np.frombuffer(self.evalue, dtype=np.float64),
+            "bitscore": np.frombuffer(self.bitscore, dtype=np.float32),
+            "taxon": np.frombuffer(self.taxon, dtype=np.int32),
+        }
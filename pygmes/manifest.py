@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    yields a temporary path next to path, which is renamed to path once
+    the block finished. If the block fails, the temporary file is removed
+    and an older path is left untouched.
+    """
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def atomic_copy(src, dst):
+    with atomic_output(dst) as tmp:
+        shutil.copy(src, tmp)
+
+
+def file_info(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def _jsonable(o):
+    # numpy scalars in lineages and vote counts
+    if hasattr(o, "item"):
+        return o.item()
+    raise TypeError("Can not store %s in the manifest" % type(o))
+
+
+class manifest:
+    """
+    journal of a run, so a restarted run continues where it stopped.
+
+    Every finished step is appended as a single JSON line, holding its
+    result, the state needed to continue without running it again, its
+    output files (size and modification time) and its run time.
+    The first line holds the settings of the run. If they changed, the
+    old journal is moved to <path>.old and the run starts over.
+
+    A step is only taken from the journal if its output files still
+    have the recorded size and modification time, so files cut short
+    or changed after the step are noticed without reading them.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = json.loads(json.dumps(settings, default=_jsonable))
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path) and not self.load():
+            logging.info("Settings changed since the last run, starting over")
+            os.replace(path, "{}.old".format(path))
+        if not os.path.exists(path):
+            self.append({"settings": self.settings, "started": time.time()})
+        elif len(self.entries) > 0:
+            logging.info("Resuming the run, %d steps are finished already" % len(self.entries))
+
+    def load(self):
+        """read the journal, returns False if it was written with other settings"""
+        with open(self.path) as fin:
+            lines = fin.read().split("\n")
+        for i, line in enumerate(lines):
+            if line.strip() == "":
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line is cut short if the run was killed while writing it
+                logging.debug("Ignoring line %d of the manifest" % (i + 1))
+                continue
+            if "settings" in entry:
+                if entry["settings"] != self.settings:
+                    return False
+            elif entry.get("status") == "done":
+                self.entries[entry["task"]] = entry
+            else:
+                self.entries.pop(entry.get("task"), None)
+        return True
+
+    def append(self, entry):
+        line = json.dumps(entry, default=_jsonable) + "\n"
+        with self.lock:
+            with open(self.path, "a") as fout:
+                fout.write(line)
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def finished(self, task):
+        """the journal entry of task, if it finished and its files are unchanged"""
+        entry = self.entries.get(task)
+        if entry is None:
+            return None
+        for path, info in entry["files"].items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                logging.debug("Output %s of %s is missing, running it again" % (path, task))
+                return None
+            if st.st_size != info["size"] or st.st_mtime_ns != info["mtime"]:
+                logging.debug("Output %s of %s changed, running it again" % (path, task))
+                return None
+        return entry
+
+    def record(self, task, result, state=None, files=(), seconds=None):
+        """add a finished step, a step with a missing output is recorded as failed"""
+        files = [f for f in files if f is not None]
+        for f in files:
+            if not os.path.exists(f):
+                logging.warning("Output %s of %s is missing, it runs again on the next run" % (f, task))
+                self.fail(task, seconds)
+                return
+        entry = {
+            "task": task,
+            "status": "done",
+            "result": result,
+            "state": state,
+            "files": {f: file_info(f) for f in files},
+            "seconds": seconds,
+            "finished": time.time(),
+        }
+        self.append(entry)
+        self.entries[task] = entry
+
+    def fail(self, task, seconds=None):
+        """add a failed step, it runs again on the next run"""
+        self.append({"task": task, "status": "failed", "seconds": seconds, "finished": time.time()})
+        self.entries.pop(task, None)
@@ -0,0 +1,296 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from pygmes.config import cache_dir
+from pygmes.parallel import run_parallel
+from pygmes.taxonomy import get_taxonomy
+
+# the public mirror of the pretrained models
+url = "ftp://ftp.ebi.ac.uk/pub/databases/metagenomics/pygmes/latest/"
+
+
+class modelindex:
+    """
+    lineage of every pretrained model, together with an inverted
+    index from each taxid to the models having it in their lineage.
+    """
+
+    def __init__(self, lineages, index=None):
+        self.lineages = lineages
+        self.models = list(lineages.keys())
+        if index is None:
+            index = defaultdict(list)
+            for i, model in enumerate(self.models):
+                for taxid in set(lineages[model]):
+                    index[taxid].append(i)
+        self.index = index
+
+    @classmethod
+    def from_info(cls, info):
+        """build the index from the content of info.csv (model,taxid per line)"""
+        ncbi = get_taxonomy()
+        lineages = {}
+        for line in info.split("\n"):
+            l = line.split(",")
+            if len(l) > 1:
+                try:
+                    lineages[l[0]] = ncbi.get_lineage(l[1])
+                except ValueError:
+                    logging.warning("Could not find the lineage of model %s (taxid %s)" % (l[0], l[1]))
+        return cls(lineages)
+
+    def save(self, path, key):
+        # a unique temporary file, as several runs can share the cache
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w") as fout:
+                json.dump({"key": key, "lineages": self.lineages, "index": self.index}, fout)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, key):
+        """returns the saved index, or None if it was made for other input"""
+        try:
+            with open(path) as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        if data.get("key") != key:
+            return None
+        index = {int(taxid): models for taxid, models in data["index"].items()}
+        return cls(data["lineages"], index)
+
+    def score(self, lng):
+        """
+        number of taxids each model shares with lng. Only models sharing
+        at least one taxid are returned, in the order of the index
+        """
+        counts = defaultdict(int)
+        for taxid in set(lng):
+            for i in self.index.get(taxid, ()):
+                counts[i] += 1
+        return [(self.models[i], counts[i]) for i in sorted(counts.keys())]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_modelindex(info):
+    """
+    returns the model index for the content of info.csv.
+    The index is kept in memory and in the cache folder, and is only
+    rebuilt if info.csv or the taxonomy snapshot changed.
+    """
+    ncbi = get_taxonomy()
+    st = os.stat(ncbi.path)
+    key = hashlib.sha256("{}\n{}\n{}".format(info, st.st_size, st.st_mtime).encode()).hexdigest()
+    with _lock:
+        if key not in _indexes:
+            # kept apart from the model store, which may be shared between nodes
+            folder = cache_dir("modelindex")
+            path = os.path.join(folder, "index.json")
+            index = modelindex.load(path, key)
+            if index is None:
+                logging.debug("Building the model lineage index")
+                index = modelindex.from_info(info)
+                os.makedirs(folder, exist_ok=True)
+                index.save(path, key)
+            _indexes[key] = index
+    return _indexes[key]
+
+
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class modelstore:
+    """
+    local store of the pretrained models.
+
+    Models are saved once under their sha256 checksum in root/objects
+    and checked against it before they are used. root/names/<name>.sha256
+    holds the checksum of each model, one file per model, so nodes sharing
+    the store never overwrite each other's entries. The list of models
+    (info.csv) is kept as well, so a filled store works without network access.
+
+    remote can be a ftp://, http:// or file:// url or a local folder
+    laid out like the public mirror (info.csv and models/<name>.mod.gz).
+    If info.csv has a third column, it is used as the expected sha256
+    of the uncompressed model.
+    """
+
+    def __init__(self, root=None, remote=None):
+        if root is None:
+            root = os.environ.get("PYGMES_MODELS", cache_dir("models"))
+        if remote is None:
+            remote = os.environ.get("PYGMES_MODELS_URL", url)
+        self.root = os.path.abspath(root)
+        self.remote = remote
+        self.objects = os.path.join(self.root, "objects")
+        self.names = os.path.join(self.root, "names")
+        self.infofile = os.path.join(self.root, "info.csv")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.names, exist_ok=True)
+        self.verified = set()
+        self.expected = {}
+
+    def remote_path(self, name):
+        if "://" in self.remote:
+            return "{}/{}".format(self.remote.rstrip("/"), name)
+        return os.path.join(self.remote, name)
+
+    def download(self, name, tries=4):
+        """returns the content of a file on the remote, retrying with a short backoff"""
+        path = self.remote_path(name)
+        if "://" not in path:
+            with open(path, "rb") as fin:
+                return fin.read()
+        for i in range(tries):
+            try:
+                logging.debug("opening url {}".format(path))
+                with urllib.request.urlopen(path, timeout=60) as response:
+                    return response.read()
+            except urllib.error.URLError:
+                if i == tries - 1:
+                    raise
+                time.sleep(0.5 * 2 ** i)
+
+    def fetch_info(self):
+        """
+        content of info.csv. Falls back to the stored copy if the remote
+        can not be reached
+        """
+        try:
+            info = self.download("info.csv", tries=1 if os.path.exists(self.infofile) else 4).decode("utf-8")
+            self.write(self.infofile, info.encode())
+        except (OSError, urllib.error.URLError):
+            if not os.path.exists(self.infofile):
+                logging.error("Could not fetch model file")
+                exit(1)
+            logging.warning("Could not reach %s, using the stored list of models" % self.remote)
+            with open(self.infofile) as fin:
+                info = fin.read()
+        for line in info.split("\n"):
+            l = line.strip().split(",")
+            if len(l) > 2 and len(l[2]) == 64:
+                self.expected[l[0]] = l[2]
+        return info
+
+    def write(self, path, data):
+        # a unique temporary file, also between nodes sharing the store
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def checksum(self, name):
+        """stored checksum of model name, or None"""
+        try:
+            with open(os.path.join(self.names, "{}.sha256".format(name))) as fin:
+                return fin.read().strip()
+        except OSError:
+            return None
+
+    def fetch(self, name):
+        """returns the path of the verified model name, downloading it if needed"""
+        checksum = self.checksum(name)
+        if checksum is not None and self.expected.get(name, checksum) == checksum:
+            path = os.path.join(self.objects, checksum)
+            if checksum in self.verified:
+                return path
+            if os.path.exists(path) and sha256sum(path) == checksum:
+                self.verified.add(checksum)
+                return path
+            logging.warning("Stored model %s is missing or damaged, fetching it again" % name)
+
+        data = gzip.decompress(self.download("models/{}.mod.gz".format(name)))
+        checksum = hashlib.sha256(data).hexdigest()
+        if name in self.expected and self.expected[name] != checksum:
+            raise ValueError("Checksum mismatch for model %s" % name)
+        path = os.path.join(self.objects, checksum)
+        self.write(path, data)
+        self.verified.add(checksum)
+        self.write(os.path.join(self.names, "{}.sha256".format(name)), checksum.encode())
+        return path
+
+    def prefetch(self, names, nworkers=8):
+        """fetch all models at once, returns the models that could not be fetched"""
+        _, failed = run_parallel(self.fetch, names, nworkers, label="model download")
+        return failed
+
+    def link(self, names, folder):
+        """link the models into folder as <name>.mod"""
+        self.prefetch(names)
+        for name in names:
+            try:
+                path = self.fetch(name)
+            except Exception as e:
+                logging.warning("Could not fetch model %s: %s" % (name, e))
+                continue
+            target = os.path.join(folder, "{}.mod".format(name))
+            try:
+                os.symlink(path, target)
+            except OSError:
+                shutil.copy(path, target)
+
+
+_store = None
+_storelock = threading.Lock()
+
+
+def set_modelstore(root=None, remote=None):
+    """use the model store at root, fetching missing models from remote"""
+    global _store
+    with _storelock:
+        _store = modelstore(root, remote)
+    return _store
+
+
+def get_modelstore():
+    """returns the model store used by pygmes"""
+    global _store
+    with _storelock:
+        if _store is None:
+            _store = modelstore()
+    return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download all pretrained models into the local model store.")
+    parser.add_argument("--store", "-s", type=str, default=None, help="Path of the model store")
+    parser.add_argument("--remote", "-r", type=str, default=None, help="url or folder to fetch the models from")
+    parser.add_argument("--ncores", "-n", type=int, default=8, help="Number of models to fetch at once")
+    options = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %H:%M:%S: ", level=logging.INFO)
+    store = modelstore(options.store, options.remote)
+    info = store.fetch_info()
+    names = [line.split(",")[0] for line in info.split("\n") if len(line.split(",")) > 1]
+    failed = store.prefetch(names, options.ncores)
+    logging.info("Stored %d models in %s" % (len(names) - len(failed), store.root))
+    if len(failed) > 0:
+        logging.error("Could not fetch %d models" % len(failed))
+        exit(1)
@@ -0,0 +1,163 @@
+import logging
+import os
+import resource
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pygmes.timings import get_timings
+
+
+class RunCancelled(Exception):
+    """Raised by run_command if the command was stopped early"""
+
+    pass
+
+
+def run_command(cmd, cwd=None, log=None, cancel=None, shell=True, limits=None):
+    """
+    Run an external command like subprocess.run(check=True).
+
+    If cancel is a threading.Event, the command (and everything it started)
+    is killed as soon as the event is set and RunCancelled is raised.
+
+    limits maps resource limits (such as resource.RLIMIT_AS) to a value.
+    They are set with prlimit right after the command started, as
+    preexec_fn is not safe while other threads are running.
+
+    The command is reaped with os.wait4, so its CPU time and peak memory
+    are known and added to the stage running in this thread (see timings).
+    """
+    if shell and not isinstance(cmd, str):
+        cmd = " ".join(cmd)
+    proc = subprocess.Popen(cmd, cwd=cwd, shell=shell, stdout=log, stderr=log, start_new_session=True)
+    if limits is not None:
+        try:
+            for limit, value in limits.items():
+                resource.prlimit(proc.pid, limit, (value, value))
+        except OSError as e:
+            logging.warning("Could not limit the resources of %s: %s" % (cmd, e))
+    done = threading.Event()
+    cancelled = threading.Event()
+
+    def watch():
+        while not done.wait(1):
+            if cancel.is_set():
+                cancelled.set()
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                return
+
+    if cancel is not None:
+        threading.Thread(target=watch, daemon=True).start()
+    try:
+        pid, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        done.set()
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    get_timings().add_tool(usage)
+    if cancelled.is_set():
+        raise RunCancelled(cmd)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def killed(returncode):
+    """whether a command was killed by a signal, which the shell reports as 128 + the signal"""
+    return returncode < 0 or returncode > 128
+
+
+def run_parallel(func, items, nworkers=1, label="task"):
+    """
+    Call func(item) for every item using up to nworkers threads.
+
+    All work in pygmes is done by external programs, so threads are enough
+    to keep all cores busy. A failing item is logged and does not stop the
+    other items.
+
+    Returns a dict mapping each item to its result and a list of the
+    items that failed.
+    """
+    results = {}
+    failed = []
+    nworkers = max(1, min(nworkers, len(items)))
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                logging.warning("The %s failed for %s: %s" % (label, item, e))
+                failed.append(item)
+    return results, failed
+
+
+def cores_for_size(size, ncores, bytes_per_core=5000000, maxcores=8):
+    """
+    Number of cores to give a GeneMark-ES run on a genome fasta of size bytes
+    (headers and line breaks included, a little more than its bp).
+    Small bins can not make use of many cores, so we give one core
+    per bytes_per_core, but never more than maxcores or ncores.
+    """
+    cores = -(-size // bytes_per_core)
+    return max(1, min(cores, maxcores, ncores))
+
+
+class corescheduler:
+    """
+    Run jobs that each need a number of cores, while never using more
+    than ncores cores at once.
+
+    Jobs are started largest first, so a single large job does not end up
+    running alone at the end. A job only starts once enough cores are free.
+    """
+
+    def __init__(self, ncores):
+        self.ncores = max(1, ncores)
+        self.jobs = []
+
+    def add(self, name, func, cores=1, size=0):
+        """
+        func is called as func(cores), so it can pass the number of
+        cores on to the external tool
+        """
+        cores = max(1, min(cores, self.ncores))
+        self.jobs.append((name, func, cores, size))
+
+    def run(self):
+        results = {}
+        failed = []
+        if len(self.jobs) == 0:
+            return results, failed
+        jobs = sorted(self.jobs, key=lambda x: x[3], reverse=True)
+        free = [self.ncores]
+        lock = threading.Condition()
+
+        def release(cores):
+            with lock:
+                free[0] += cores
+                lock.notify_all()
+
+        futures = {}
+        with ThreadPoolExecutor(max_workers=min(self.ncores, len(jobs))) as pool:
+            for name, func, cores, size in jobs:
+                with lock:
+                    while free[0] < cores:
+                        lock.wait()
+                    free[0] -= cores
+                logging.debug("Starting %s with %d cores (%d free)" % (name, cores, free[0]))
+                future = pool.submit(func, cores)
+                future.add_done_callback(lambda f, c=cores: release(c))
+                futures[future] = name
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.warning("Job %s failed: %s" % (name, e))
+                    failed.append(name)
+        self.jobs = []
+        return results, failed
@@ -0,0 +1,292 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pygmes.progress import get_progress
+
+
+class dag:
+    """
+    run tasks as soon as the tasks they depend on are finished.
+
+    Tasks are blocking functions (in pygmes they wait for external
+    programs), so they run in threads, driven by an asyncio loop. While
+    it runs, each task takes its number of cores from a budget of ncores.
+    Tasks waiting for cores are started largest first.
+
+    A failing task is logged and has the result None. Tasks depending on
+    it still run and decide themselves what to do.
+
+    If a journal (see pygmes.manifest) is given, tasks with a checkpoint
+    are recorded in it once finished. On the next run they are restored
+    from the journal instead of running again, as long as all the tasks
+    they depend on were restored as well.
+
+    Tasks starting, finishing, failing and being restored are reported
+    to the progress stream (see pygmes.progress).
+    """
+
+    def __init__(self, ncores=1, journal=None):
+        self.ncores = max(1, ncores)
+        self.journal = journal
+        self.tasks = {}
+        self.batches = {}
+        self.results = {}
+        self.failed = []
+        self.restored = set()
+
+    def add(self, name, func, deps=(), cores=1, size=0, lazydeps=None, checkpoint=None):
+        """
+        add a task, func is called as func(cores).
+
+        cores can be a function, called once the dependencies are
+        finished, so a task that turns out to have nothing to do can
+        ask for 0 cores. lazydeps can be a function returning more tasks
+        to wait for, also called once the dependencies are finished, so a
+        task only waits for these if it needs them.
+
+        checkpoint is a tuple of two functions: save(result) returns the
+        state to keep and the output files of the task, restore(state)
+        sets the state again instead of running the task.
+        """
+        self.tasks[name] = (func, list(deps), cores, size, lazydeps, checkpoint)
+        return name
+
+    def add_batch(self, name, func, members, cores=1, wait=None, size=None, mincores=None, checkpoint=None):
+        """
+        add a batch point, to handle the work of many members at once.
+
+        members maps each member to the task it waits for. If that task
+        finishes with a true result, the member joins the next batch.
+        func is called as func(cores, index, members) for each batch and
+        returns a dict of each member to its result. The result of every
+        member is the result of the task "name:member".
+
+        By default all members go into a single batch. If wait (seconds)
+        is set, a batch is started wait seconds after its first member
+        joined, or once it has size members. If mincores is set, a batch
+        starts once that many cores are free, and takes up to cores of them.
+        The checkpoint functions of a batch are called per member, as
+        save(member, result) and restore(member, state).
+        """
+        self.batches[name] = (func, dict(members), cores, wait, size, mincores, checkpoint)
+        return name
+
+    def run(self):
+        """run all tasks, returns the results of all tasks and the names of the failed tasks"""
+        return asyncio.run(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self.free = self.ncores
+        self.waiting = []
+        self.order = itertools.count()
+        self.done = {name: loop.create_future() for name in self.tasks.keys()}
+        for name, batch in self.batches.items():
+            for member in batch[1].keys():
+                self.done["{}:{}".format(name, member)] = loop.create_future()
+        unknown = set([d for task in self.tasks.values() for d in task[1]]) - set(self.done)
+        unknown |= set([d for batch in self.batches.values() for d in batch[1].values()]) - set(self.done)
+        if len(unknown) > 0:
+            raise ValueError("Unknown dependencies: %s" % ", ".join(sorted(unknown)))
+        self.pool = ThreadPoolExecutor(max_workers=max(4, 2 * self.ncores))
+        try:
+            await asyncio.gather(
+                *[self._task(name) for name in self.tasks.keys()], *[self._batch(name) for name in self.batches.keys()]
+            )
+        finally:
+            self.pool.shutdown()
+        return self.results, self.failed
+
+    async def acquire(self, cores, size, mincores=None):
+        """wait for free cores, returns the number of cores taken"""
+        if cores == 0:
+            return 0
+        if mincores is None:
+            mincores = cores
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (-size, next(self.order), cores, min(mincores, cores), future))
+        self.grant()
+        return await future
+
+    def release(self, cores):
+        self.free += cores
+        self.grant()
+
+    def grant(self):
+        # the largest waiting task starts first, smaller ones do not overtake it
+        while len(self.waiting) > 0 and self.waiting[0][3] <= self.free:
+            size, i, cores, mincores, future = heapq.heappop(self.waiting)
+            cores = min(cores, self.free)
+            self.free -= cores
+            future.set_result(cores)
+
+    async def call(self, name, func, cores, size, *args, mincores=None, event=None):
+        cores = await self.acquire(max(0, min(cores, self.ncores)), size, mincores)
+        logging.debug("Starting %s with %d cores (%d free)" % (name, cores, self.free))
+        progress = get_progress()
+        progress.task_started(name, cores, len(self.waiting), event)
+        error = None
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, func, cores, *args)
+        except Exception as e:
+            logging.warning("Task %s failed: %s" % (name, e))
+            self.failed.append(name)
+            error = e
+            result = None
+        finally:
+            self.release(cores)
+        progress.task_finished(name, len(self.waiting), error, event)
+        logging.debug("Finished %s" % name)
+        return result
+
+    def resume(self, name, deps, restore):
+        """restore a task from the journal, returns its journal entry or None"""
+        if self.journal is None or restore is None:
+            return None
+        if not all([d in self.restored for d in deps]):
+            return None
+        entry = self.journal.finished(name)
+        if entry is None:
+            return None
+        try:
+            restore(entry["state"])
+        except Exception as e:
+            logging.debug("Could not restore %s, running it again: %s" % (name, e))
+            return None
+        logging.debug("Restored %s from the manifest" % name)
+        self.restored.add(name)
+        get_progress().task_restored(name)
+        return entry
+
+    def journaled(self, name, func, save):
+        """func, recording its result in the journal"""
+        if self.journal is None or save is None:
+            return func
+
+        def run(cores):
+            start = time.time()
+            try:
+                result = func(cores)
+            except Exception:
+                self.journal.fail(name, time.time() - start)
+                raise
+            state, files = save(result)
+            self.journal.record(name, result, state, files, time.time() - start)
+            return result
+
+        return run
+
+    async def _task(self, name):
+        func, deps, cores, size, lazydeps, checkpoint = self.tasks[name]
+        save, restore = checkpoint if checkpoint is not None else (None, None)
+        for d in deps:
+            await self.done[d]
+        entry = None
+        try:
+            if lazydeps is not None:
+                lazy = lazydeps()
+                for d in lazy:
+                    await self.done[d]
+                deps = deps + list(lazy)
+            entry = self.resume(name, deps, restore)
+            if entry is None and callable(cores):
+                cores = cores()
+        except Exception as e:
+            logging.warning("Task %s failed: %s" % (name, e))
+            self.failed.append(name)
+            get_progress().task_finished(name, len(self.waiting), e)
+            func = None
+        if entry is not None:
+            result = entry["result"]
+        elif func is None:
+            result = None
+        else:
+            result = await self.call(name, self.journaled(name, func, save), cores, size)
+        self.results[name] = result
+        self.done[name].set_result(result)
+
+    async def _batch(self, name):
+        func, members, cores, wait, size, mincores, checkpoint = self.batches[name]
+        restore = checkpoint[1] if checkpoint is not None else None
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def join(member, dep):
+            queue.put_nowait((member, await self.done[dep]))
+
+        joins = [asyncio.ensure_future(join(member, dep)) for member, dep in members.items()]
+        batches = []
+
+        def start(ready):
+            batches.append(asyncio.ensure_future(self._flush(name, len(batches) + 1, ready)))
+
+        remaining = len(members)
+        ready = {}
+        deadline = None
+        while remaining > 0:
+            timeout = None
+            if wait is not None and len(ready) > 0:
+                timeout = max(0, deadline - loop.time())
+            try:
+                member, result = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                start(ready)
+                ready = {}
+                continue
+            remaining -= 1
+            task = "{}:{}".format(name, member)
+            if not result:
+                if members[member] in self.restored:
+                    self.restored.add(task)
+                self.finish(name, member, None)
+                continue
+            entry = self.resume(task, [members[member]], None if restore is None else lambda s: restore(member, s))
+            if entry is not None:
+                self.finish(name, member, entry["result"])
+                continue
+            ready[member] = result
+            if len(ready) == 1 and wait is not None:
+                deadline = loop.time() + wait
+            if size is not None and len(ready) >= size:
+                start(ready)
+                ready = {}
+        if len(ready) > 0:
+            start(ready)
+        await asyncio.gather(*joins, *batches)
+
+    def journaled_batch(self, name, func, save):
+        """batch func, recording the result of each member in the journal"""
+        if self.journal is None or save is None:
+            return func
+
+        def run(cores, index, members):
+            start = time.time()
+            results = func(cores, index, members)
+            seconds = time.time() - start
+            for member, result in results.items():
+                if member in members:
+                    state, files = save(member, result)
+                    self.journal.record("{}:{}".format(name, member), result, state, files, seconds)
+            return results
+
+        return run
+
+    async def _flush(self, name, index, members):
+        func, _, cores, wait, size, mincores, checkpoint = self.batches[name]
+        func = self.journaled_batch(name, func, checkpoint[0] if checkpoint is not None else None)
+        label = "{} batch {} ({} members)".format(name, index, len(members))
+        # many tasks wait for a batch, so it goes before all waiting tasks
+        event = {"stage": name, "batch": index, "members": len(members)}
+        results = await self.call(label, func, cores, float("inf"), index, members, mincores=mincores, event=event)
+        if results is None:
+            results = {}
+        for member in members.keys():
+            self.finish(name, member, results.get(member))
+
+    def finish(self, name, member, result):
+        task = "{}:{}".format(name, member)
+        self.results[task] = result
+        self.done[task].set_result(result)
@@ -1,5 +1,5 @@
 import logging
-from ete3 import NCBITaxa
+from pygmes.taxonomy import get_taxonomy
 
 
 def compare_taxa(tax1, tax2):
@@ -146,7 +146,7 @@ def write_lngs(lngs, outfile):
     write infered taxonomy in a machine and human readble format
     """
     logging.info("Translating lineage")
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy()
     with open(outfile, "w") as fout:
         fout.write("bin\ttaxid\tncbi_rank\tncbi_name\tbasedon\n")
         for binname, lngi in lngs.items():
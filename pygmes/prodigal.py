@@ -1,42 +1,75 @@
 import logging
 import os
-import subprocess
 import re
+import subprocess
+from pygmes.resultcache import get_resultcache
+from pygmes.manifest import atomic_output
+from pygmes.parallel import run_command, killed
+from pygmes.timings import stage, mark
 
 
 class prodigal:
-    def __init__(self, seq, outdir, ncores):
+    """
+    Prodigal is single threaded, so ncores is only kept for compatibility.
+    To use more cores, run several bins at once (see metapygmes).
+    If run is False, the output of an earlier run in outdir is used.
+    name labels the run in the timings, it defaults to the file name of seq.
+    """
+
+    def __init__(self, seq, outdir, ncores=1, run=True, name=None):
         self.seq = seq
         self.outdir = outdir
+        self.name = name if name is not None else os.path.basename(seq)
         self.logfile = os.path.join(outdir, "prodigal.log")
-        if ncores == 1:
-            logging.warning(
-                "You are running Prodigal with a single core. This will be slow. We recommend using 4-8 cores."
-            )
-        self.faa = self.run(ncores)
-        self.bed = self.make_bed()
+        if not run:
+            self.faa = os.path.join(self.outdir, "prot.faa")
+            self.bed = os.path.join(self.outdir, "prot.bed")
+            return
+        with stage("prodigal", bin=self.name, cores=ncores):
+            self.faa = self.run(ncores)
+            self.bed = self.make_bed()
 
     def run(self, cores=1):
         logging.debug("Launching prodigal now: %s" % self.seq)
         co = os.path.join(self.outdir, "genecoord.bgk")
         faa = os.path.join(self.outdir, "prot.faa")
-        lst = ["prodigal", "-i", self.seq, "-p", "meta", "-o", co, "-a", faa]
+        cache = get_resultcache()
+        key = cache.key("prodigal", ["-p", "meta"], [self.seq])
+        files = ["genecoord.bgk", "prot.faa"]
+        status = cache.restore(key, self.outdir, files)
+        if status == "ok":
+            logging.debug("Using cached prodigal output")
+            mark("cached")
+            return faa
+        elif status == "failed":
+            logging.debug("Prodigal failed on this input before, skipping")
+            mark("failed")
+            return faa
         try:
-            # do not rerun for now if we already attempted the training once
-            if not os.path.exists(faa):
+            # prodigal writes to temporary files, so an interrupted run leaves no partial output
+            with atomic_output(co) as cotmp, atomic_output(faa) as faatmp:
+                lst = ["prodigal", "-i", self.seq, "-p", "meta", "-o", cotmp, "-a", faatmp]
                 with open(self.logfile, "w") as fout:
-                    subprocess.run(" ".join(lst), cwd=self.outdir, check=True, shell=True, stdout=fout, stderr=fout)
-            else:
-                logging.debug("Prodigal output already exists")
-        except Exception:
-            logging.warning("Prodigal failed on this bin")
+                    run_command(lst, cwd=self.outdir, log=fout)
+            cache.store(key, self.outdir, files)
+        except Exception as e:
+            logging.warning("Prodigal failed on this bin: %s" % self.seq)
+            mark("failed")
+            # do not keep partial output
+            if os.path.exists(faa):
+                os.remove(faa)
+            # a run killed by a signal (such as the OOM killer) might succeed next time
+            if isinstance(e, subprocess.CalledProcessError) and not killed(e.returncode):
+                cache.store(key, self.outdir, files, success=False)
         return faa
 
     def make_bed(self):
         # parser for rpodigals faa using header information
         bedpath = os.path.join(self.outdir, "prot.bed")
+        if not self.check_success():
+            return bedpath
         reg = re.compile(r"([\w\d.\-\+]+)_[0-9]+")
-        with open(self.faa) as fin, open(bedpath, "w") as fout:
+        with atomic_output(bedpath) as tmp, open(self.faa) as fin, open(tmp, "w") as fout:
             for line in fin:
                 if not line.startswith(">"):
                     continue
@@ -71,8 +104,8 @@ class prodigal:
         return bedpath
 
     def check_success(self):
-        if os.stat(self.faa).st_size == 0:
-            return False
         if not os.path.exists(self.faa):
             return False
+        if os.stat(self.faa).st_size == 0:
+            return False
         return True
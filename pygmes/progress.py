@@ -0,0 +1,180 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+
+class progress:
+    """
+    progress of a run as a stream of JSON lines, for a workflow manager to follow.
+
+    Each line is one event with its time, the seconds since the run
+    started and further fields depending on the event:
+
+    - start and end of the run
+    - started, finished and failed for each task, with its stage, bin,
+      cores and the number of tasks waiting for cores
+    - restored for tasks continued from an earlier run
+    - failed for stages where a tool failed (see pygmes.timings)
+    - bin for each finished bin, with the bytes done and the ETA
+    - heartbeat every interval seconds, with the running tasks
+
+    The ETA is the remaining bytes of input divided by the rate at which
+    the last window bins were finished, so it follows a run that speeds up
+    or slows down. path can be a FIFO, opening it waits for a reader.
+    Without a path no events are written.
+    """
+
+    def __init__(self, path=None, interval=60, window=20):
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.out = None
+        # tasks finishing a bin, with the name and size of the bin
+        self.bins = {}
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bins_done = 0
+        # bytes of bins processed in this run (not restored) over time, for the rate
+        self.processed = 0
+        self.history = collections.deque([(self.started, 0)], maxlen=window + 1)
+        self.running = {}
+        self.queue = 0
+        self.stop = threading.Event()
+        if path is not None:
+            self.out = open(path, "a", buffering=1)
+
+    def emit(self, event, **fields):
+        if self.out is None:
+            return
+        now = time.time()
+        entry = {"time": round(now, 3), "elapsed": round(now - self.started, 3), "event": event}
+        entry.update(fields)
+        line = json.dumps(entry, default=str) + "\n"
+        with self.lock:
+            if self.out is None:
+                return
+            try:
+                self.out.write(line)
+            except OSError as e:
+                # the reader went away, this must not stop the run
+                logging.warning("Stopped writing progress to %s: %s" % (self.path, e))
+                self.out = None
+
+    def track(self, task, name, size):
+        """count the bin name of size bytes as done once task is finished"""
+        self.bins[task] = (name, size)
+        self.bytes_total += size
+
+    def start(self, **fields):
+        self.emit("start", bins=len(self.bins), bytes_total=self.bytes_total, **fields)
+        if self.out is not None and self.interval:
+            threading.Thread(target=self.beat, daemon=True).start()
+
+    def end(self, **fields):
+        self.stop.set()
+        self.emit("end", bins_done=self.bins_done, bytes_done=self.bytes_done, **fields)
+
+    def beat(self):
+        while not self.stop.wait(self.interval):
+            now = time.time()
+            running = {task: round(now - start, 1) for task, start in list(self.running.items())}
+            self.emit("heartbeat", running=running, queue=self.queue, **self.estimate())
+
+    def task_started(self, task, cores, queue, fields=None):
+        """fields describe the task, by default its stage and bin are taken from its name"""
+        self.running[task] = time.time()
+        self.queue = queue
+        fields = describe(task, fields)
+        self.emit("started", cores=cores, queue=queue, running=len(self.running), **fields)
+
+    def task_finished(self, task, queue, error=None, fields=None):
+        start = self.running.pop(task, time.time())
+        self.queue = queue
+        fields = describe(task, fields)
+        fields.update({"seconds": round(time.time() - start, 3), "queue": queue})
+        if error is not None:
+            self.emit("failed", error=str(error), **fields)
+        else:
+            self.emit("finished", **fields)
+        self.bin_done(task, processed=True)
+
+    def task_restored(self, task):
+        self.emit("restored", **describe(task))
+        self.bin_done(task, processed=False)
+
+    def stage_failed(self, record):
+        """a stage (see pygmes.timings) where a tool failed"""
+        self.emit("failed", stage=record["stage"], bin=record["bin"], model=record["model"], seconds=record["wall"])
+
+    def bin_done(self, task, processed):
+        if task not in self.bins:
+            return
+        name, size = self.bins[task]
+        with self.lock:
+            self.bins_done += 1
+            self.bytes_done += size
+            if processed:
+                self.processed += size
+                self.history.append((time.time(), self.processed))
+        self.emit(
+            "bin",
+            bin=name,
+            bytes=size,
+            bins_done=self.bins_done,
+            bins_total=len(self.bins),
+            bytes_done=self.bytes_done,
+            bytes_total=self.bytes_total,
+            **self.estimate()
+        )
+
+    def estimate(self):
+        """rate in bytes per second over the last bins and the seconds left"""
+        with self.lock:
+            first, before = self.history[0]
+            after = self.history[-1][1]
+            remaining = self.bytes_total - self.bytes_done
+        if after == before:
+            return {"rate": None, "eta": None}
+        # count the time since the last bin, so a stalled run gets a growing ETA
+        rate = (after - before) / max(time.time() - first, 1e-6)
+        return {"rate": round(rate, 1), "eta": round(remaining / rate, 1)}
+
+    def close(self):
+        self.stop.set()
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
+
+def describe(task, fields=None):
+    """fields of a task event, the stage and bin are taken from a task named stage:bin"""
+    if fields is None:
+        stage, _, bin = task.partition(":")
+        fields = {"stage": stage, "bin": bin if bin else None}
+    return dict(fields, task=task)
+
+
+_progress = None
+_lock = threading.Lock()
+
+
+def set_progress(path=None, interval=60):
+    """start a new progress stream, written to path"""
+    global _progress
+    with _lock:
+        if _progress is not None:
+            _progress.close()
+        _progress = progress(path, interval)
+    return _progress
+
+
+def get_progress():
+    global _progress
+    with _lock:
+        if _progress is None:
+            _progress = progress()
+    return _progress
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from pygmes.config import cache_dir
+
+_hashes = {}
+_versions = {}
+
+
+def file_hash(path):
+    """sha256 of a file, remembered as long as the file does not change"""
+    st = os.stat(path)
+    memo = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if memo not in _hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(1 << 20), b""):
+                h.update(block)
+        _hashes[memo] = h.hexdigest()
+    return _hashes[memo]
+
+
+def file_identity(path):
+    """cheap identity of a large file (such as a diamond database) that is not hashed, or of its path if it is missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return os.path.abspath(path)
+    return "{}:{}:{}".format(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+def tool_version(tool):
+    """
+    identity of an installed tool, based on the resolved executable.
+    Updating or replacing the tool changes it.
+    """
+    if tool not in _versions:
+        path = shutil.which(tool)
+        if path is None:
+            _versions[tool] = "missing"
+        else:
+            _versions[tool] = file_identity(path)
+    return _versions[tool]
+
+
+class resultcache:
+    """
+    cache of tool outputs, shared between runs and output folders.
+
+    Results are stored under a key made from the tool version, the
+    relevant command line arguments and the content of the input files.
+    If any of these change, the key changes and the tool is run again.
+    Cached files are copied, never linked, as the tools later rewrite some
+    of their outputs in place.
+
+    Failed runs are only recorded in their output folder, so a later run
+    in the same folder does not retry them. Other folders run the tool
+    again, as the failure might have been caused by this run.
+    """
+
+    failed = "failed.json"
+
+    def __init__(self, root=None, enabled=True):
+        if root is None:
+            root = cache_dir("results")
+        self.root = root
+        self.enabled = enabled
+
+    def key(self, tool, args, inputs=(), identities=()):
+        """
+        inputs are hashed by content, identities (large databases)
+        only by path, size and modification time
+        """
+        h = hashlib.sha256()
+        desc = {
+            "tool": tool,
+            "version": tool_version(tool),
+            "args": [str(a) for a in args],
+            "inputs": [file_hash(f) for f in inputs],
+            "identities": [file_identity(f) for f in identities],
+        }
+        h.update(json.dumps(desc, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, outdir, files):
+        """
+        put the cached files into outdir.
+        Returns "ok" or "failed" for a cached result, None if there is none
+        """
+        if not self.enabled:
+            return None
+        if key in self.failures(outdir):
+            return "failed"
+        entry = self.path(key)
+        try:
+            with open(os.path.join(entry, "result.json")) as fin:
+                result = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        if result["status"] != "ok":
+            return None
+        try:
+            for f in files:
+                target = os.path.join(outdir, f)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.exists(target):
+                    os.remove(target)
+                shutil.copyfile(os.path.join(entry, f), target)
+        except OSError as e:
+            logging.warning("Could not restore cached result %s: %s" % (key, e))
+            return None
+        logging.debug("Restored cached result %s" % key)
+        return "ok"
+
+    def failures(self, outdir):
+        """keys of the runs that failed in outdir"""
+        try:
+            with open(os.path.join(outdir, self.failed)) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return {}
+
+    def store(self, key, outdir, files, success=True):
+        """
+        add the files in outdir to the cache, or record a failed run in outdir.
+        Only record failures that happen again with the same input, such as
+        a tool exiting with an error, but not a killed or cancelled run.
+        """
+        if not self.enabled:
+            return
+        if not success:
+            failures = self.failures(outdir)
+            failures[key] = time.time()
+            path = os.path.join(outdir, self.failed)
+            tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            try:
+                with open(tmp, "w") as fout:
+                    json.dump(failures, fout)
+                os.replace(tmp, path)
+            except OSError as e:
+                logging.debug("Could not record failed result %s: %s" % (key, e))
+            return
+        entry = self.path(key)
+        if os.path.exists(entry):
+            return
+        # build the entry in a temporary folder, so it appears complete or not at all
+        tmp = "{}.{}.{}.tmp".format(entry, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(tmp)
+            for f in files:
+                os.makedirs(os.path.dirname(os.path.join(tmp, f)), exist_ok=True)
+                shutil.copy(os.path.join(outdir, f), os.path.join(tmp, f))
+            with open(os.path.join(tmp, "result.json"), "w") as fout:
+                json.dump({"status": "ok", "files": list(files), "time": time.time()}, fout)
+            os.rename(tmp, entry)
+        except OSError as e:
+            logging.debug("Could not cache result %s: %s" % (key, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def set_resultcache(root=None, enabled=True):
+    global _cache
+    with _lock:
+        _cache = resultcache(root, enabled)
+    return _cache
+
+
+def get_resultcache():
+    """returns the result cache used by pygmes"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = resultcache(enabled=os.environ.get("PYGMES_NO_CACHE") is None)
+    return _cache
@@ -0,0 +1,216 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from pygmes.config import cache_dir
+
+MAGIC = b"PYGMESTX"
+VERSION = 1
+# ete3 keeps its sqlite database here, a newer database makes the snapshot stale
+ETE3_DB = os.path.join(os.path.expanduser("~"), ".etetoolkit", "taxa.sqlite")
+
+
+def default_path():
+    """the snapshot path, can be changed with the environment variable PYGMES_TAXONOMY"""
+    return os.environ.get("PYGMES_TAXONOMY", cache_dir("taxonomy.bin"))
+
+
+def build_taxonomy(output, ncbi=None):
+    """
+    export the NCBI taxonomy of ete3 into a snapshot file
+    that can be memory mapped by the taxonomy class
+    """
+    if ncbi is None:
+        from ete3 import NCBITaxa
+
+        ncbi = NCBITaxa()
+    logging.debug("Exporting the NCBI taxonomy from ete3")
+    rows = ncbi.db.execute("SELECT taxid, parent, rank, spname FROM species").fetchall()
+    merged = ncbi.db.execute("SELECT taxid_old, taxid_new FROM merged").fetchall()
+    write_taxonomy(output, rows, merged)
+
+
+def write_taxonomy(output, rows, merged=()):
+    """
+    write a taxonomy snapshot.
+
+    rows are tuples of (taxid, parent, rank, name), merged are tuples
+    of (old taxid, new taxid). The file holds a small json header and
+    then one array slot per taxid for the parent, the merged taxid, the
+    offset of the name and the rank code, followed by all names.
+    """
+    rows = [(int(t), int(p), r, n) for t, p, r, n in rows]
+    merged = [(int(o), int(n)) for o, n in merged]
+    size = max([r[0] for r in rows] + [m[0] for m in merged]) + 1
+
+    parent = array("i", [-1]) * size
+    alias = array("i", [0]) * size
+    rank = bytearray(size)
+    ranks = ["no rank"]
+    rankcode = {"no rank": 0}
+    names = {}
+    for taxid, p, r, name in rows:
+        parent[taxid] = p
+        if r not in rankcode:
+            rankcode[r] = len(ranks)
+            ranks.append(r)
+        rank[taxid] = rankcode[r]
+        names[taxid] = name.encode()
+    for old, new in merged:
+        alias[old] = new
+
+    offsets = array("I", [0]) * (size + 1)
+    blob = bytearray()
+    for taxid in range(size):
+        offsets[taxid] = len(blob)
+        if taxid in names:
+            blob += names[taxid]
+    offsets[size] = len(blob)
+
+    header = json.dumps({"size": size, "ranks": ranks, "byteorder": sys.byteorder}).encode()
+    # pad so all arrays are aligned
+    header += b" " * (-len(header) % 8)
+    # a unique temporary file, as several runs can build the shared snapshot at once
+    folder = os.path.dirname(os.path.abspath(output))
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(output) + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(MAGIC)
+            fout.write(struct.pack("<II", VERSION, len(header)))
+            fout.write(header)
+            fout.write(parent.tobytes())
+            fout.write(alias.tobytes())
+            fout.write(offsets.tobytes())
+            fout.write(bytes(rank))
+            fout.write(bytes(blob))
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class taxonomy:
+    """
+    read only view on a taxonomy snapshot.
+
+    The file is memory mapped, so opening it is instant and
+    lineages are resolved by walking the parent array.
+    The methods mirror the ones of ete3.NCBITaxa used in pygmes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:8] != MAGIC:
+            raise ValueError("Not a pygmes taxonomy file: %s" % path)
+        version, headerlen = struct.unpack("<II", self._mm[8:16])
+        if version != VERSION:
+            raise ValueError("Unsupported taxonomy file version %d: %s" % (version, path))
+        start = 16 + headerlen
+        header = json.loads(self._mm[16:start].decode())
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("Taxonomy file was built on a machine with a different byte order: %s" % path)
+        self.size = size = header["size"]
+        self.ranks = header["ranks"]
+
+        # slice the file into the arrays written by write_taxonomy
+        mv = memoryview(self._mm)
+        arrays = {}
+        for name, length in [("parent", 4 * size), ("alias", 4 * size), ("offsets", 4 * (size + 1)), ("rank", size)]:
+            end = start + length
+            arrays[name] = mv[start:end]
+            start = end
+        self.parent = arrays["parent"].cast("i")
+        self.alias = arrays["alias"].cast("i")
+        self.offsets = arrays["offsets"].cast("I")
+        self.rank = arrays["rank"]
+        self.names = mv[start:]
+        self._lineages = {}
+
+    def translate(self, taxid):
+        """returns the current taxid of taxid or None if it is unknown"""
+        taxid = int(taxid)
+        if taxid <= 0 or taxid >= self.size:
+            return None
+        if self.parent[taxid] == -1:
+            if self.alias[taxid] == 0:
+                return None
+            return self.alias[taxid]
+        return taxid
+
+    def get_lineage(self, taxid):
+        """lineage of taxid starting at the root, raises a ValueError for unknown taxids"""
+        taxid = int(taxid)
+        if taxid in self._lineages:
+            return list(self._lineages[taxid])
+        t = self.translate(taxid)
+        if t is None:
+            raise ValueError("%s taxid not found" % taxid)
+        lng = [t]
+        while t != 1 and len(lng) < 1000:
+            t = self.parent[t]
+            if t <= 0:
+                break
+            lng.append(t)
+        lng.reverse()
+        self._lineages[taxid] = lng
+        return list(lng)
+
+    def get_rank(self, taxids):
+        ranks = {}
+        for taxid in taxids:
+            t = self.translate(taxid)
+            if t is not None:
+                ranks[int(taxid)] = self.ranks[self.rank[t]]
+        return ranks
+
+    def get_taxid_translator(self, taxids):
+        names = {}
+        for taxid in taxids:
+            t = self.translate(taxid)
+            if t is not None:
+                start, end = self.offsets[t], self.offsets[t + 1]
+                names[int(taxid)] = bytes(self.names[start:end]).decode()
+        return names
+
+
+_taxonomy = None
+_lock = threading.Lock()
+
+
+def get_taxonomy(path=None):
+    """
+    returns the shared taxonomy, building the snapshot from
+    the ete3 database if it does not exist yet or is outdated
+    """
+    global _taxonomy
+    with _lock:
+        if _taxonomy is None:
+            if path is None:
+                path = default_path()
+            stale = os.path.exists(path) and os.path.exists(ETE3_DB)
+            stale = stale and os.path.getmtime(ETE3_DB) > os.path.getmtime(path)
+            if not os.path.exists(path) or stale:
+                logging.info("Building the taxonomy snapshot %s, this is only done once" % path)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                build_taxonomy(path)
+            _taxonomy = taxonomy(path)
+    return _taxonomy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the taxonomy snapshot used by pygmes from ete3.")
+    parser.add_argument("--output", "-o", type=str, default=default_path(), help="Path of the snapshot")
+    options = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %H:%M:%S: ", level=logging.INFO)
+    os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+    build_taxonomy(options.output)
+    logging.info("Wrote taxonomy snapshot to %s" % options.output)
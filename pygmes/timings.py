@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pygmes.progress import get_progress
+
+
+class timings:
+    """
+    resources used by each stage of a run, written as run report.
+
+    A stage is timed with the stage context manager, tagged with its bin,
+    model and number of cores. Besides the wall time and the CPU time of
+    pygmes itself, each external tool run during the stage (see
+    run_command) adds its CPU time and peak memory. These are taken from
+    os.wait4, so they only count that tool and the processes it started,
+    even while other stages run tools at the same time.
+    """
+
+    fields = [
+        "bin",
+        "stage",
+        "model",
+        "cores",
+        "status",
+        "start",
+        "wall",
+        "cpu",
+        "tools",
+        "tool_user",
+        "tool_sys",
+        "tool_maxrss",
+    ]
+
+    def __init__(self):
+        self.records = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current(self):
+        """record of the stage running in this thread"""
+        return getattr(self.local, "record", None)
+
+    @contextmanager
+    def attach(self, record):
+        """count the tools run in this thread towards record, a stage of another thread"""
+        parent = self.current()
+        self.local.record = record
+        try:
+            yield record
+        finally:
+            self.local.record = parent
+
+    @contextmanager
+    def stage(self, stage, bin=None, model=None, cores=None):
+        """
+        time a stage. Yields its record, status can be changed to
+        mark a failed or cached stage
+        """
+        record = {
+            "bin": bin,
+            "stage": stage,
+            "model": model,
+            "cores": cores,
+            "status": "ok",
+            "start": time.time(),
+            "tools": 0,
+            "tool_user": 0.0,
+            "tool_sys": 0.0,
+            "tool_maxrss": 0.0,
+        }
+        cpu = time.thread_time()
+        try:
+            with self.attach(record):
+                yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wall"] = time.time() - record["start"]
+            record["cpu"] = time.thread_time() - cpu
+            with self.lock:
+                self.records.append(record)
+            if record["status"] == "failed":
+                get_progress().stage_failed(record)
+
+    def add_tool(self, usage):
+        """add the resource usage of a finished tool to the current stage"""
+        record = self.current()
+        if record is None:
+            return
+        with self.lock:
+            record["tools"] += 1
+            record["tool_user"] += usage.ru_utime
+            record["tool_sys"] += usage.ru_stime
+            # ru_maxrss is in kB on Linux
+            record["tool_maxrss"] = max(record["tool_maxrss"], usage.ru_maxrss / 1024)
+
+    def write(self, outdir):
+        """write timings.tsv and timings.json to outdir"""
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r["start"])
+        tsv = os.path.join(outdir, "timings.tsv")
+        with open(tsv, "w") as fout:
+            fout.write("\t".join(self.fields) + "\n")
+            for r in records:
+                row = []
+                for key in self.fields:
+                    v = r[key]
+                    if v is None:
+                        v = "NA"
+                    elif isinstance(v, float):
+                        v = "%.3f" % v
+                    row.append(str(v))
+                fout.write("\t".join(row) + "\n")
+        report = {"started": self.started, "wall": time.time() - self.started, "stages": records}
+        with open(os.path.join(outdir, "timings.json"), "w") as fout:
+            json.dump(report, fout, indent=1)
+        logging.debug("Wrote timings of %d stages to %s" % (len(records), tsv))
+
+
+_timings = None
+_lock = threading.Lock()
+
+
+def set_timings():
+    """start a new run report"""
+    global _timings
+    with _lock:
+        _timings = timings()
+    return _timings
+
+
+def get_timings():
+    global _timings
+    with _lock:
+        if _timings is None:
+            _timings = timings()
+    return _timings
+
+
+def stage(stage, bin=None, model=None, cores=None):
+    """time a stage of the current run, see timings.stage"""
+    return get_timings().stage(stage, bin, model, cores)
+
+
+def mark(status):
+    """set the status of the stage running in this thread, such as cached or failed"""
+    record = get_timings().current()
+    if record is not None:
+        record["status"] = status
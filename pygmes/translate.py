@@ -0,0 +1,119 @@
+import logging
+import threading
+from collections import defaultdict
+import numpy as np
+from pyfaidx import Fasta
+from pygmes.gtf import iter_features
+from pygmes.manifest import atomic_output
+
+# standard genetic code, codons ordered TTT, TTC, TTA, TTG, TCT, ...
+_bases = "TCAG"
+_aminoacids = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+
+# map nucleotides to 0-3, everything else to 4
+_nuc = np.full(256, 4, dtype=np.uint8)
+for i, b in enumerate(_bases):
+    _nuc[ord(b)] = i
+    _nuc[ord(b.lower())] = i
+# codon index to amino acid, index 64 is used for codons with unknown bases
+_code = np.frombuffer((_aminoacids + "X").encode(), dtype=np.uint8)
+_complement = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+_index_lock = threading.Lock()
+
+
+def indexed_fasta(fasta, **kwargs):
+    """
+    pyfaidx Fasta of a genome. Several threads open the same genome,
+    so the .fai index is created under a lock, never read half written
+    """
+    with _index_lock:
+        return Fasta(fasta, **kwargs)
+
+
+def read_cds(gtf):
+    """
+    read the CDS features of each gene in one pass over the gtf.
+    Returns the genes in the order of the gtf, each with its contig,
+    strand, the range of all its features and its CDS as 0-based
+    (start, stop, frame)
+    """
+    genes = {}
+    for name, chrom, feature, start, stop, strand, frame in iter_features(gtf):
+        if name not in genes:
+            genes[name] = {"chrom": chrom, "strand": strand, "start": start, "stop": stop, "cds": []}
+        g = genes[name]
+        g["start"] = min(g["start"], start)
+        g["stop"] = max(g["stop"], stop)
+        if feature == "CDS":
+            frame = int(frame) if frame in ("0", "1", "2") else 0
+            g["cds"].append((start - 1, stop, frame))
+    return genes
+
+
+def splice(fa, gene):
+    """coding sequence of a gene as bytes, in the direction of transcription"""
+    contig = fa[gene["chrom"]]
+    cds = sorted(gene["cds"])
+    seq = b"".join([contig[start:stop].encode() for start, stop, frame in cds])
+    if gene["strand"] == "-":
+        seq = seq.translate(_complement)[::-1]
+        frame = cds[-1][2]
+    else:
+        frame = cds[0][2]
+    # skip the bases of an incomplete first codon
+    end = len(seq) - (len(seq) - frame) % 3
+    return seq[frame:end]
+
+
+def translate(seqs):
+    """translate a batch of coding sequences at once"""
+    if len(seqs) == 0:
+        return []
+    codons = _nuc[np.frombuffer(b"".join(seqs), dtype=np.uint8)].reshape(-1, 3).astype(np.uint16)
+    index = codons[:, 0] * 16 + codons[:, 1] * 4 + codons[:, 2]
+    # any unknown base makes the whole codon unknown
+    index[(codons == 4).any(axis=1)] = 64
+    protein = _code[index].tobytes()
+    proteins = []
+    start = 0
+    for seq in seqs:
+        end = start + len(seq) // 3
+        proteins.append(protein[start:end].rstrip(b"*"))
+        start = end
+    return proteins
+
+
+def gtf_to_proteins(gtf, fasta, faa, bed, batchsize=2000):
+    """
+    translate the genes of a GeneMark-ES gtf and write them renamed
+    to >contigname_ORFNUMBER into faa, with their positions in bed.
+    Returns the number of proteins written
+    """
+    genes = read_cds(gtf)
+    orfcounter = defaultdict(int)
+    n = 0
+    names = [name for name in genes.keys() if len(genes[name]["cds"]) > 0]
+    fa = indexed_fasta(fasta, as_raw=True)
+    try:
+        # the proteins only appear once complete, a crash leaves no truncated faa or bed
+        with atomic_output(faa) as faatmp, atomic_output(bed) as bedtmp:
+            with open(faatmp, "w") as fout, open(bedtmp, "w") as bout:
+                for start in range(0, len(names), batchsize):
+                    end = start + batchsize
+                    batch = names[start:end]
+                    proteins = translate([splice(fa, genes[name]) for name in batch])
+                    for name, protein in zip(batch, proteins):
+                        if len(protein) == 0:
+                            logging.debug("Gene %s has no complete codon, skipping" % name)
+                            continue
+                        g = genes[name]
+                        orfcounter[g["chrom"]] += 1
+                        # we use 1 as the first number, instead of the cool 0
+                        newprotname = "{}_{}".format(g["chrom"], orfcounter[g["chrom"]])
+                        fout.write(">{}\n{}\n".format(newprotname, protein.decode()))
+                        bout.write("\t".join([g["chrom"], str(g["start"]), str(g["stop"]), g["strand"], newprotname]))
+                        bout.write("\n")
+                        n += 1
+    finally:
+        fa.close()
+    return n
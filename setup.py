@@ -17,8 +17,14 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     py_modules=["api"],
     include_package_data=True,
-    entry_points={"console_scripts": ["pygmes = pygmes.api:main"]},
-    install_requires=["ete3", "pyfaidx>=0.5.8"],
+    entry_points={
+        "console_scripts": [
+            "pygmes = pygmes.api:main",
+            "pygmes-taxonomy = pygmes.taxonomy:main",
+            "pygmes-models = pygmes.models:main",
+        ]
+    },
+    install_requires=["ete3", "pyfaidx>=0.5.8", "numpy"],
     packages=setuptools.find_packages(),
     license="GPLv3",
     classifiers=[